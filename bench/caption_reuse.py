@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""
+Checks that a drop name can take a new caption after its last one was used,
+both through `put` and through lines appended to `post_options.txt`, and
+that reading an edited file again doesn't bring used captions back.
+
+Run from the repository root: `python3 -m bench.caption_reuse`
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from src.internal.caption_store import CaptionStore
+
+
+def append(path, line):
+    with open(path, "a") as file:
+        file.write(line + "\n")
+    # so the import doesn't wait for the line to settle
+    os.utime(path, (time.time() - 10, time.time() - 10))
+
+
+def main():
+    checks = {}
+    with tempfile.TemporaryDirectory() as folder:
+        store = CaptionStore(f"{folder}/captions.sqlite3")
+        store.put("image.jpg", {"caption": "first"})
+        checks["first caption used"] = store.consume("image.jpg") == {"caption": "first"}
+        store.put("image.jpg", {"caption": "second"})
+        checks["put -> consume -> put -> peek gives the second caption"] = store.peek("image.jpg") == {"caption": "second"}
+        store.consume("image.jpg")
+
+        options = f"{folder}/post_options.txt"
+        append(options, "filename | caption")
+        append(options, "meme.png | one")
+        store.import_text(options)
+        checks["imported caption used"] = store.consume("meme.png") == {"caption": "one"}
+        append(options, "meme.png | two")
+        store.import_text(options)
+        checks["appended line for a used name is up for use"] = store.peek("meme.png") == {"caption": "two"}
+        store.consume("meme.png")
+
+        # an edit that shrinks the file makes it get read again from the top
+        with open(options, "w") as file:
+            file.write("filename | caption\nmeme.png | two\n")
+        os.utime(options, (time.time() - 10, time.time() - 10))
+        store.import_text(options)
+        checks["reading an edited file again keeps used captions used"] = store.peek("meme.png") is None
+
+    for check, ok in checks.items(): print(f"  {'ok  ' if ok else 'FAIL'} {check}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
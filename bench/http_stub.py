@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Exercises the instrumented HTTP transport against a local stub server, so
+its pooling, timeouts, retries and stats can be checked without instagram.
+
+The stub answers like a slow API (`/api/v1/...`), takes uploads
+(`/rupload_igphoto/...`), fails the first try of `/api/v1/flaky/` with a
+503, and never answers `/api/v1/hang/` in time. Prints what the transport
+recorded for each endpoint, and whether it behaved.
+
+Run from the repository root: `python3 -m bench.http_stub [requests]`
+"""
+
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from src.internal import stats
+from src.internal import http_transport
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+    # headers and body in one write, or delayed acks show up as read time
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+    flaky = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args): pass
+
+    def __reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.path.startswith("/api/v1/hang/"):
+            time.sleep(2)
+            return self.__reply(200, {"status": "ok"})
+        if self.path.startswith("/api/v1/flaky/"):
+            with self.lock:
+                tries = self.flaky[self.command] = self.flaky.get(self.command, 0) + 1
+            if tries == 1: return self.__reply(503, {"status": "fail", "message": "try again"})
+        time.sleep(0.01 if self.path.startswith("/rupload") else 0.02)
+        self.__reply(200, {"status": "ok", "received": len(body)})
+
+    def do_GET(self): self.__handle()
+    def do_POST(self): self.__handle()
+
+
+def summarize():
+    snap = stats.snapshot()
+    rows = {}
+    for (name, labels), value in snap["counters"].items():
+        labels = dict(labels)
+        if "endpoint" not in labels: continue
+        row = rows.setdefault(labels["endpoint"], {"statuses": {}, "sent": 0, "received": 0, "retries": 0})
+        if name == "http_requests": row["statuses"][labels["status"]] = row["statuses"].get(labels["status"], 0) + value
+        elif name == "http_sent_bytes": row["sent"] += value
+        elif name == "http_received_bytes": row["received"] += value
+        elif name == "http_retries": row["retries"] += value
+    for (name, labels), hist in snap["histograms"].items():
+        labels = dict(labels)
+        if "endpoint" not in labels or not hist["count"]: continue
+        key = "total" if name == "http_request_seconds" else labels.get("phase")
+        rows[labels["endpoint"]][key] = 1000 * hist["sum"] / hist["count"]
+    for name, row in sorted(rows.items()):
+        phases = "  ".join(f"{phase} {row[phase]:7.2f}ms" for phase in ("connect", "wait", "read") if phase in row)
+        print(f"  {name:<28} avg {row.get('total', 0):8.2f}ms  {phases}  up {row['sent']:>9}B  down {row['received']:>7}B"
+              f"  retries {row['retries']:>2}  {row['statuses']}")
+    connections = sum(value for (name, labels), value in snap["counters"].items() if name == "http_connections")
+    return rows, connections
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.handle_error = lambda request, address: None  # the client hanging up on /hang/ is the point
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    session = requests.Session()
+    http_transport.install(session, http_transport.InstrumentedAdapter(connect_timeout=2, read_timeout=0.5, retries=2))
+    payload = b"\xff" * 256_000
+    for i in range(count):
+        session.get(f"{base}/api/v1/feed/timeline/", params={"i": i})
+        session.post(f"{base}/rupload_igphoto/{int(time.time()*1000)}_0_{i}", data=payload)
+    flaky_get = session.get(f"{base}/api/v1/flaky/").status_code
+    flaky_post = session.post(f"{base}/api/v1/flaky/", data=b"{}").status_code
+    try:
+        session.get(f"{base}/api/v1/hang/")
+        timed_out = False
+    except requests.exceptions.RequestException:
+        timed_out = True
+    server.shutdown()
+
+    print(f"{2*count + 3} requests to the stub:")
+    rows, connections = summarize()
+    print()
+    checks = {
+        "connections reused (keep-alive)": connections < count,
+        "GET retried past a 503": flaky_get == 200,
+        "POST not retried on a 503": flaky_post == 503,
+        "read timeout applied": timed_out,
+        "upload bytes counted": rows["/rupload_igphoto/:id"]["sent"] == count * len(payload),
+    }
+    for check, ok in checks.items(): print(f"  {'ok  ' if ok else 'FAIL'} {check}")
+    print(f"  ({connections} connections opened)")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
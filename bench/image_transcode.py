@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Compares the old `mogrify` subprocess image conversion against the
+in-process Pillow one.
+
+Run from the repository root: `python3 -m bench.image_transcode [count]`
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import statistics
+
+from PIL import Image
+
+from src.internal.file_io import transcode_image
+
+
+def make_images(folder, count):
+    """ Writes `count` noisy images of mixed formats and sizes, roughly what ends up in media/outbound. """
+    paths = []
+    for i in range(count):
+        w, h = random.choice([(1080, 1080), (1080, 1350), (1920, 1080), (3024, 4032)])
+        fmt, mode = random.choice([("png", "RGBA"), ("jpeg", "RGB"), ("webp", "RGB")])
+        image = Image.effect_noise((w//4, h//4), 64).resize((w, h)).convert(mode)
+        path = f"{folder}/img{i}.{'jpg' if fmt == 'jpeg' else fmt}"
+        image.save(path, format=fmt)
+        paths.append(path)
+    return paths
+
+
+def old_mogrify(path, out_path):
+    # what change_file_type used to do: convert next to the source, then rename
+    folder, name = os.path.split(path)
+    subprocess.run(["mogrify", "-format", "jpg", path], check=True)
+    os.rename(f"{folder}/{os.path.splitext(name)[0]}.jpg", out_path)
+
+
+def run(name, func, paths, out_folder):
+    times = []
+    for i,path in enumerate(paths):
+        start = time.perf_counter()
+        func(path, f"{out_folder}/{name}-{i}.jpg")
+        times.append(time.perf_counter() - start)
+    total = sum(times)
+    print(f"{name:>8}: {len(paths)} files in {total:.2f}s  "
+          f"({len(paths)/total:.1f} files/s, median {statistics.median(times)*1000:.1f}ms)")
+    return total
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    work = tempfile.mkdtemp(prefix="bench-transcode-")
+    try:
+        src, out = f"{work}/src", f"{work}/out"
+        os.makedirs(src); os.makedirs(out)
+        paths = make_images(src, count)
+        # mogrify writes beside (and for jpgs, over) its input, so give it its own copies
+        copies = f"{work}/copies"
+        shutil.copytree(src, copies)
+        copied = [f"{copies}/{os.path.basename(p)}" for p in paths]
+        pil = run("pillow", transcode_image, paths, out)
+        if shutil.which("mogrify") is None:
+            print(" mogrify: not installed, skipped")
+            return
+        mog = run("mogrify", old_mogrify, copied, out)
+        print(f"speedup: {mog/pil:.2f}x")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
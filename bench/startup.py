@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Startup cost of each run mode: how long importing and constructing its Bot
+takes, the peak RSS afterwards, and which heavy packages got loaded.
+
+Each measurement is a fresh interpreter in a throwaway working directory,
+repeated a few times; the median is reported.
+
+Run from the repository root: `python3 -m bench.startup [repeats]`
+"""
+
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import subprocess
+import statistics
+
+
+MODES = ("sort", "standalone", "webserver")
+HEAVY = ("instagrapi", "pydantic", "aiohttp", "magic", "PIL", "moviepy")
+
+CHILD = """
+import sys, time, json, resource
+start = time.perf_counter()
+import src.config as config
+config.OUTPUT_TO_CONSOLE = False
+config.WEBSERVER_PORT = {port}
+import run
+Bot = run.bot_class({mode!r})
+imported = time.perf_counter()
+bot = Bot()
+built = time.perf_counter()
+with open("startup.json", "w") as file: json.dump({{
+    "import_seconds": imported - start,
+    "construct_seconds": built - imported,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+}}, file)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def measure(mode, repo):
+    work = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        # the bot works relative to its directory; give it the code, but a clean media/
+        os.symlink(os.path.join(repo, "src"), os.path.join(work, "src"))
+        os.symlink(os.path.join(repo, "run.py"), os.path.join(work, "run.py"))
+        # results go to a file, the webserver prints from its own thread
+        subprocess.run([sys.executable, "-c", CHILD.format(mode=mode, port=free_port(), heavy=HEAVY)],
+                       cwd=work, stdout=subprocess.DEVNULL, check=True)
+        with open(os.path.join(work, "startup.json")) as file:
+            return json.load(file)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    repo = os.getcwd()
+    for mode in MODES:
+        runs = [measure(mode, repo) for _ in range(repeats)]
+        median = lambda key: statistics.median(run[key] for run in runs)
+        print(f"{mode:>10}: import {median('import_seconds')*1000:7.0f}ms   construct {median('construct_seconds')*1000:6.0f}ms   "
+              f"peak RSS {median('peak_rss_mb'):6.1f} MB   loaded: {', '.join(runs[0]['loaded']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""
+Offline end-to-end benchmark: a synthetic corpus of JPEG, PNG, WebP, MP4 and
+MOV files is sorted through the real `ConvertPool` (with a `DedupIndex`, like
+the sorter), restored from the queue journal, and posted through the real
+`PostQueue` and `get_next_options` to a stub Client that only records the
+upload calls.
+
+Every file in the corpus is generated on its own, so nothing is a copy of
+anything else and the dedup index has real work to do (and nothing to
+discard). The bot's config is pinned to `src/config.py.example`, whatever
+`src/config.py` says, so runs on different machines measure the same thing.
+
+Each scale runs in its own process (so peak RSS means something) inside a
+throwaway working directory. Results are printed and saved under
+`bench/results/`, and can be compared against an earlier run. A reference
+run is kept in `bench/baseline.json`.
+
+Run from the repository root:
+    python3 -m bench.suite [--scales 1000,10000,100000] [--small] [--compare bench/baseline.json]
+
+`--small` uses smaller images (and shorter videos), for quick runs at the big scales.
+Videos need `ffmpeg` and are left out of the corpus without it.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib.util
+import importlib.machinery
+
+from PIL import Image
+
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+CONFIG_EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "config.py.example")
+# what the results depend on, saved with them
+CONFIG_RECORDED = ("CONVERT_WORKERS", "CONVERT_MAX_IMAGE", "CONVERT_MAX_VIDEO", "DEDUP_MAX_DISTANCE", "JPEG_QUALITY",
+                   "VIDEO_PRESET", "VIDEO_CRF", "OPTIMIZE_MEDIA", "ASPECT_POLICY", "POST_ALBUM_SIZE")
+
+# (format, pillow mode, size) - phone photos, screenshots and saved memes
+IMAGE_KINDS = [
+    ("jpeg", "RGB",  (3024, 4032)),
+    ("jpeg", "RGB",  (1080, 1350)),
+    ("png",  "RGBA", (1080, 1080)),
+    ("png",  "RGB",  (1170, 2532)),
+    ("webp", "RGB",  (1080, 1080)),
+]
+# (extension, ffmpeg codec arguments, size, seconds) - one that remuxes, one that needs a re-encode
+VIDEO_KINDS = [
+    ("mp4", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac"], (1080, 1350), 8),
+    ("mov", ["-c:v", "mpeg4", "-q:v", "5", "-c:a", "aac"], (1920, 1080), 8),
+]
+VIDEO_SHARE = 0.1
+
+
+# CORPUS
+
+
+def make_image(path, fmt, mode, size, rng):
+    # seeded noise, so the encoder has real work to do, files come out at realistic sizes,
+    # and no two files look alike
+    w, h = size
+    noise = Image.frombytes("L", (w//8, h//8), rng.randbytes((w//8) * (h//8)))
+    noise.resize((w, h)).convert(mode).save(path, format=fmt)
+
+def make_video(path, codec, size, seconds, rng):
+    w, h = size
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", f"life=size={w}x{h}:rate=30:mold=10:seed={rng.randrange(2**31)}",
+                    "-f", "lavfi", "-i", f"sine=frequency={rng.randrange(110, 880)}",
+                    "-t", str(seconds), *codec, "-pix_fmt", "yuv420p", path], check=True)
+
+def make_corpus(folder, count, small=False, seed=0):
+    """ Writes `count` distinct files to `folder`. Returns their paths. """
+    rng = random.Random(seed)
+    videos = shutil.which("ffmpeg") is not None
+    if not videos: print("ffmpeg not installed, corpus has no videos", file=sys.stderr)
+    paths = []
+    for i in range(count):
+        if videos and rng.random() < VIDEO_SHARE:
+            kind = rng.randrange(len(VIDEO_KINDS))
+            ext, codec, (w, h), seconds = VIDEO_KINDS[kind]
+            if small: w, h, seconds = w//2 + w//2 % 2, h//2 + h//2 % 2, 3.5
+            path = f"{folder}/{i:06d}-v{kind}.{ext}"
+            make_video(path, codec, (w, h), seconds, rng)
+        else:
+            kind = rng.randrange(len(IMAGE_KINDS))
+            fmt, mode, (w, h) = IMAGE_KINDS[kind]
+            # still above MEDIA_MIN_WIDTH, so nothing gets rejected for size
+            if small: w, h = w//2, h//2
+            path = f"{folder}/{i:06d}-i{kind}.{'jpg' if fmt == 'jpeg' else fmt}"
+            make_image(path, fmt, mode, (w, h), rng)
+        paths.append(path)
+    return paths
+
+def unique_files(paths):
+    """ How many different contents there are among `paths`. """
+    hashes = set()
+    for path in paths:
+        with open(path, "rb") as file: hashes.add(hashlib.sha1(file.read()).digest())
+    return len(hashes)
+
+
+# CONFIG
+
+
+def pin_config():
+    """ Loads `src/config.py.example` as `src.config`, before anything else imports the real one. """
+    if "src.config" in sys.modules: raise RuntimeError("src.config was imported before it could be pinned")
+    import src
+    loader = importlib.machinery.SourceFileLoader("src.config", CONFIG_EXAMPLE)
+    config = importlib.util.module_from_spec(importlib.util.spec_from_loader("src.config", loader))
+    loader.exec_module(config)
+    sys.modules["src.config"] = src.config = config
+    return config
+
+
+# STUB CLIENT
+
+
+class StubMedia:
+    def __init__(self, id):
+        self.id = id
+    def dict(self):
+        return {"id": self.id, "taken_at": datetime.datetime.now()}
+
+
+class StubClient:
+    """ Stands in for instagrapi's Client: records what would have been uploaded, never touches the network. """
+
+    def __init__(self):
+        self.uploads = []
+        self.likes = 0
+        self.__lock = threading.Lock()
+
+    def __upload(self, kind, path, caption="", **kwargs):
+        with self.__lock:
+            self.uploads.append((kind, path, caption, sorted(kwargs)))
+            return StubMedia(str(len(self.uploads)))
+
+    def photo_upload(self, path, caption="", **kwargs):
+        return self.__upload("photo", path, caption, **kwargs)
+
+    def video_upload(self, path, caption="", **kwargs):
+        return self.__upload("video", path, caption, **kwargs)
+
+    def media_like(self, media_id):
+        self.likes += 1
+        return True
+
+
+class Finished:
+    """ Passed to the ConvertPool as its gate, to hear when each file is done. """
+
+    def __init__(self):
+        self.at = {}
+        self.rejected_count = 0
+        self.__lock = threading.Lock()
+
+    def accepted(self, path):
+        with self.__lock: self.at[path] = time.perf_counter()
+
+    def rejected(self, path):
+        with self.__lock:
+            self.at[path] = time.perf_counter()
+            self.rejected_count += 1
+
+
+# MEASURING
+
+
+def percentile(ordered, q):
+    if not ordered: return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def summarize(times, wall=None):
+    """ Throughput and latency percentiles (ms) of a list of per-operation durations. """
+    ordered = sorted(times)
+    wall = sum(times) if wall is None else wall
+    return {
+        "count": len(times),
+        "seconds": round(wall, 4),
+        "per_second": round(len(times) / wall, 2) if wall else None,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+def peak_rss_mb():
+    # kilobytes on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024*1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ONE SCALE
+
+
+def run_scale(count, small=False, seed=0):
+    """ Runs every stage for `count` files in a fresh working directory. Returns the results. """
+    repo = os.getcwd()
+    work = tempfile.mkdtemp(prefix=f"bench-suite-{count}-")
+    try:
+        os.chdir(work)
+        for folder in ("media/outbound", "media/sorted/jpg", "media/sorted/mp4", "media/tmp",
+                       "media/discard/error", "media/discard/duplicate", "media/discard/rejected", "src"):
+            os.makedirs(folder)
+        sys.path.insert(0, repo)
+        config = pin_config()
+        # everything below uses paths relative to the working directory, like the bot does
+        from src.internal import file_io as fileio
+        from src.internal.post_queue import PostQueue
+        from src.internal.queue_journal import QueueJournal
+        from src.internal.rate_governor import RateGovernor
+        from src.internal.router import Router, Route
+        from src.internal.dedup_index import DedupIndex
+        from src.internal.convert_pool import ConvertPool
+
+        results = {"files": count, "config": {name: getattr(config, name) for name in CONFIG_RECORDED}}
+        start = time.perf_counter()
+        paths = make_corpus("media/outbound", count, small, seed)
+        results["corpus_seconds"] = round(time.perf_counter() - start, 2)
+        results["corpus_mb"] = round(sum(os.path.getsize(path) for path in paths) / 2**20, 1)
+        results["corpus_unique"] = unique_files(paths)
+
+        # captions for every other file, the way they'd be written by hand
+        os.makedirs(os.path.dirname(config.POST_OPTIONS_PATH) or ".", exist_ok=True)
+        with open(config.POST_OPTIONS_PATH, "w") as file:
+            file.write("filename | caption\n")
+            for path in paths[::2]:
+                name = os.path.splitext(os.path.basename(path))[0]
+                file.write(f"{name} | benchmark caption for {name} #meme --latlon 40.7,-74.0\n")
+
+        # no limits to wait on, the point is to time our side of things
+        unlimited = {"upload": (1e12, 1e12), "like": (1e12, 1e12), "login": (1e12, 1e12)}
+        client = StubClient()
+        lock = threading.Lock()
+        queue = PostQueue(client, journal=QueueJournal("media/queue.sqlite3"), governor=RateGovernor(None, unlimited))
+        finished = Finished()
+        pool = ConvertPool(Router([Route("bench", queue)]), lock,
+                           dedup=DedupIndex("media/dedup.sqlite3", config.DEDUP_MAX_DISTANCE), gate=finished)
+
+        # the pool's workers call it through the module, so this times each conversion on its own
+        times = []
+        convert_and_sort = fileio.convert_and_sort
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try: return convert_and_sort(*args, **kwargs)
+            finally: times.append(time.perf_counter() - start)
+        fileio.convert_and_sort = timed
+
+        # and from being handed to the pool until it is queued (or turned down), waiting for a worker included
+        submitted = {}
+        wall = time.perf_counter()
+        for path in paths:
+            submitted[path] = time.perf_counter()
+            pool.submit(path)
+        while pool.pending(): time.sleep(0.01)
+        wall = time.perf_counter() - wall
+        results["convert"] = summarize(times, wall)
+        results["convert_latency"] = summarize([finished.at[path] - submitted[path] for path in paths if path in finished.at], wall)
+        pool.shutdown()
+        results["queued"] = len(queue)
+        results["discarded"] = {reason: sum(len(files) for _, _, files in os.walk(f"media/discard/{reason}"))
+                                for reason in ("error", "duplicate", "rejected")}
+        results["discarded"]["turned_down"] = finished.rejected_count
+
+        # what a restart costs with this many files queued
+        start = time.perf_counter()
+        restored = PostQueue(client, journal=QueueJournal("media/queue.sqlite3"), governor=RateGovernor(None, unlimited))
+        items = restored.restore()
+        results["restore"] = {"items": items, "seconds": round(time.perf_counter() - start, 4)}
+
+        options_times, post_times = [], []
+        wall = time.perf_counter()
+        while len(queue):
+            start = time.perf_counter()
+            path = queue.get_next_filename()
+            kwargs = fileio.get_next_options(path, queue.source_name(path))
+            options_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            queue.post(path=path, **kwargs)
+            post_times.append(time.perf_counter() - start)
+        results["post_cycle_seconds"] = round(time.perf_counter() - wall, 4)
+        results["get_next_options"] = summarize(options_times)
+        results["post"] = summarize(post_times)
+        results["uploads"] = {"photo": sum(1 for u in client.uploads if u[0] == "photo"),
+                              "video": sum(1 for u in client.uploads if u[0] == "video"),
+                              "with_caption": sum(1 for u in client.uploads if "benchmark caption" in u[2])}
+        results["peak_rss_mb"] = peak_rss_mb()
+        return results
+    finally:
+        os.chdir(repo)
+        shutil.rmtree(work, ignore_errors=True)
+
+
+# DRIVER
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_scale(count, res, old=None):
+    print(f"\n== {count} files ({res['corpus_unique']} unique, {res['corpus_mb']} MB corpus), peak RSS {res['peak_rss_mb']} MB")
+    for stage in ("convert", "convert_latency", "get_next_options", "post"):
+        st = res[stage]
+        line = (f"  {stage:>16}: {st['per_second']:>9} /s   p50 {st['p50_ms']:>9.2f}ms   "
+                f"p90 {st['p90_ms']:>9.2f}ms   p99 {st['p99_ms']:>9.2f}ms   max {st['max_ms']:>9.2f}ms")
+        if old and stage in old and old[stage]["per_second"] and st["per_second"]:
+            line += f"   ({st['per_second'] / old[stage]['per_second']:.2f}x throughput)"
+        print(line)
+    print(f"  {'restore':>16}: {res['restore']['items']} items in {res['restore']['seconds']*1000:.1f}ms")
+    print(f"  {'discarded':>16}: {res['discarded']}")
+    print(f"  {'uploads':>16}: {res['uploads']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline sort/queue/post benchmark.")
+    parser.add_argument("--scales", default="1000", help="comma separated file counts, e.g. 1000,10000,100000")
+    parser.add_argument("--small", action="store_true", help="small images and short videos, for quick runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        # one scale, results as json on the last line
+        print(json.dumps(run_scale(args.child, args.small, args.seed)))
+        return
+
+    old = None
+    if args.compare:
+        with open(args.compare) as file: old = json.load(file)["scales"]
+    run = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "small": args.small,
+        "scales": {},
+    }
+    for count in (int(c) for c in args.scales.split(",")):
+        child = subprocess.run([sys.executable, "-m", "bench.suite", "--child", str(count), "--seed", str(args.seed)]
+                               + (["--small"] if args.small else []), stdout=subprocess.PIPE, text=True, check=True)
+        res = run["scales"][str(count)] = json.loads(child.stdout.strip().splitlines()[-1])
+        print_scale(count, res, old.get(str(count)) if old else None)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        path = os.path.join(RESULTS_FOLDER, f"{run['started'].replace(':', '')}-{run['revision'] or 'unknown'}.json")
+        with open(path, "w") as file: json.dump(run, file, indent=2)
+        print("\nSaved", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,36 @@
 #!/usr/bin/env python3
 
+"""
+Starts the bot. `python3 run.py --sort-only` (or `SORT_ONLY = True` in the config)
+only sorts and converts, without instagram or the webserver.
+
+Each mode only imports what it uses, so the sort-only one never loads instagrapi,
+and the plain one never loads aiohttp.
+"""
+
+import sys
+
 import src.config as config
 
-from src.bot_standalone import Bot as SBot
-from src.bot_webcontrol import Bot as WBot
 
-bot = WBot() if config.USE_WEBSERVER else SBot()
-bot.login()
+def bot_class(mode: str):
+    """ The Bot class for `mode`: "sort", "standalone" or "webserver". """
+    if mode == "sort":
+        from src.bot_sorter import Bot
+    elif mode == "webserver":
+        from src.bot_webcontrol import Bot
+    else:
+        from src.bot_standalone import Bot
+    return Bot
+
+def mode_from(argv) -> str:
+    if "--sort-only" in argv or config.SORT_ONLY: return "sort"
+    return "webserver" if config.USE_WEBSERVER else "standalone"
+
+
+if __name__ == "__main__":
+    mode = mode_from(sys.argv[1:])
+    bot = bot_class(mode)()
+    if mode != "sort": bot.login()
 
-bot.main_loop()
+    bot.main_loop()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+# The sort/convert half of the bot on its own: watches media/outbound, converts into media/sorted
+# and queues the results, without ever loading instagrapi. For workers that only sort.
+"""
+
+import os
+import time
+import shutil
+import threading
+
+from threadsafe_shell import get_shell, Shell
+
+from src.internal.post_queue import PostQueue
+from src.internal.queue_journal import QueueJournal
+from src.internal.router import Router, Route, account_path
+from src.internal.outbound_watcher import OutboundWatcher
+from src.internal.outbound_gate import OutboundGate
+from src.internal.convert_pool import ConvertPool
+from src.internal.dedup_index import DedupIndex
+from src.internal.scheduler import Scheduler
+from src.internal import media_layout
+
+import src.config as config
+
+
+class Bot:
+    """
+    One sort/convert pipeline feeding the queues of one or more accounts (see `ACCOUNTS`).
+    Files are converted once and handed to a single account's queue by the Router.
+
+    This class only sorts; `src.bot_standalone.Bot` adds logging in and posting on top.
+    """
+
+    def __init__(self, shell:Shell=None):
+        self.started_at = time.time()
+        self.shell = get_shell() if shell is None else shell
+        self.shell.set_debug_active(config.DEBUG)
+        self.shell.write_to_console = config.OUTPUT_TO_CONSOLE
+        self.shell.debug("Debug mode active")
+
+        self.__filesystem_lock = threading.Lock()
+        with self.__filesystem_lock:
+            if not os.path.exists("media/outbound"): os.makedirs("media/outbound")
+            if not os.path.exists("media/sorted/mp4"): os.makedirs("media/sorted/mp4")
+            if not os.path.exists("media/sorted/jpg"): os.makedirs("media/sorted/jpg")
+            if not os.path.exists("media/discard/error"): os.makedirs("media/discard/error")
+            if not os.path.exists("media/discard/duplicate"): os.makedirs("media/discard/duplicate")
+            if not os.path.exists("media/discard/rejected"): os.makedirs("media/discard/rejected")
+            if not os.path.exists("media/discard/removed"): os.makedirs("media/discard/removed")
+            if not os.path.exists("media/quarantine"): os.makedirs("media/quarantine")
+            # leftovers from conversions that were interrupted
+            shutil.rmtree("media/tmp", ignore_errors=True)
+            os.makedirs("media/tmp")
+
+        # one scheduler for everything, so a single shutdown wakes every loop
+        self.scheduler = Scheduler()
+        settings = config.ACCOUNTS or [{"username": config.IG_USERNAME, "password": config.IG_PASSWORD}]
+        for account in settings:
+            if account.get("folder"): os.makedirs("media/outbound/"+account["folder"], exist_ok=True)
+        self.router = Router(self.make_routes(settings, shared=len(settings) > 1), shell=self.shell)
+        # the first account's queue, for code that only knows about one
+        self.queue = self.router.queues[0]
+        dedup = DedupIndex(config.DEDUP_INDEX_PATH, config.DEDUP_MAX_DISTANCE) if config.DEDUP_INDEX_PATH else None
+        self.gate = OutboundGate(shell=self.shell)
+        self.convert_pool = ConvertPool(self.router, self.__filesystem_lock, dedup=dedup, gate=self.gate, shell=self.shell)
+        self.__scan_for_existing_sorted()
+
+    def make_routes(self, settings: list, shared: bool) -> list:
+        """ A Route per account in `settings`. Here just a journaled queue for each; posting bots put whole accounts behind them. """
+        routes = []
+        for account in settings:
+            journal_path = account_path(config.QUEUE_JOURNAL_PATH, account["username"], shared)
+            queue = PostQueue(None, shell=self.shell, journal=QueueJournal(journal_path) if journal_path else None)
+            queue.add_listener(self.scheduler.notify)
+            routes.append(Route(account["username"], queue, account.get("folder"), account.get("tags", ())))
+        return routes
+
+
+    def __scan_for_existing_sorted(self):
+        restored = 0
+        for queue in self.router.queues:
+            restored += queue.restore()
+        if restored: self.shell.log("Restored", self.shell.highlight(restored), "queued files from the journal.")
+        journals = [queue.journal for queue in self.router.queues if queue.journal is not None]
+        # discover old queued files, only listing trees changed behind the journals' backs
+        for folder in ("media/sorted/jpg", "media/sorted/mp4"):
+            if restored and len(journals) == len(self.router.queues) and not any(journal.folder_changed(folder) for journal in journals): continue
+            self.shell.debug("Rescanning", folder)
+            found = set()
+            for path in media_layout.walk(folder):
+                if path.endswith('.mp4.jpg'): continue  # skip autogenerated thumbnails
+                found.add(path)
+                if not any(path in queue for queue in self.router.queues):
+                    self.router.route(path).add(path)
+            for queue in self.router.queues:
+                for path in queue.paths():
+                    if path.startswith(folder+"/") and path not in found: queue.remove(path, "missing")
+            for journal in journals: journal.mark_folder_scanned(folder)
+        self.shell.log("Discovered", self.shell.highlight(len(self.router)), "files already sorted.")
+    
+
+    def __sort_paths(self, paths):
+        submitted = 0
+        total = 0
+        for path in paths:
+            if self.convert_pool.submit(path): submitted += 1
+            total += 1
+        # files are added to the queues as their conversions finish
+        if submitted: self.shell.log("Sort: Discovered", self.shell.highlight(total), "files. Converting", self.shell.highlight(submitted), "files.")
+
+    def __scan_and_sort_new_thread(self):
+        self.shell.success(f"-- Scan+Sort Thread Start --")
+        folders = [route.folder for route in self.router.routes if route.folder]
+        watcher = OutboundWatcher(subfolders=folders, shell=self.shell)
+        # drain whatever was dropped in while we weren't running
+        paths = watcher.existing()
+        while True:
+            # files still being written, or turned down recently, are held back by the gate
+            self.__sort_paths(self.gate.ready(paths))
+            paths = watcher.wait_for_new(timeout=self.gate.next_check())
+
+    def __scan_and_sort_new(self):
+        try:
+            return self.scan_thread
+        except AttributeError:
+            self.scan_thread = threading.Thread(target=self.__scan_and_sort_new_thread, name="ScanAndSortNew-Daemon", daemon=True)
+            return self.scan_thread
+
+
+    def start_posting(self) -> None:
+        self.shell.warn("Sort-only mode - nothing will be posted.")
+
+    def stop_posting(self) -> None:
+        pass
+
+    def main_loop(self):
+        """
+        Bot main loop
+        
+        Execution:
+        1. Scan for new files
+        2. Start posting, if this bot posts
+        3. Block until interrupted
+
+        Every wait blocks on the scheduler, so an idle bot uses no CPU.
+        """
+        try:
+            self.__scan_and_sort_new().start()
+            self.start_posting()
+            self.scheduler.wait_for(lambda: False)
+
+        except KeyboardInterrupt:
+            self.scheduler.shutdown()
+            self.stop_posting()
+            self.convert_pool.shutdown(wait=False)
+            self.shell.success("Exiting.")
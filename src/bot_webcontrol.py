@@ -5,17 +5,19 @@
 """
 
 import io
+import re
 import json
 import asyncio
 import aiohttp
 import threading
 from aiohttp import web
-from pathlib import Path
+from collections import deque
 
-from instagrapi import Client, exceptions
 from threadsafe_shell import get_shell, Shell
 
 import src.config as config
+from src.internal import stats
+from src.internal.static_cache import StaticCache
 from src.bot_standalone import Bot as StandaloneBot
 
 
@@ -34,23 +36,42 @@ def __add_websocket_handler_decorator(name:str = None):
 def add_websocket_handler(name:str = None, function = None):
     if name is None: raise ValueError("Websocket handler must provide a name!")
     if function is None: raise ValueError("Websocket handler must provide a function!")
-    message_handlers[name] = func
+    message_handlers[name] = function
 
 
 async def __process_message(ws, msg):
-    data, _ = json.loads(msg.data)
-    func = message_handlers.get(data['method'])
-    await func(ws, data)
+    # the panel sends [method, data]; whatever the handler returns is sent back, tagged with the request's id
+    try:
+        method, data = json.loads(msg.data)
+        if not isinstance(method, str) or not isinstance(data, dict): raise ValueError
+    except (ValueError, TypeError):
+        # a bad message gets an error back, it mustn't take the connection (and the live log) down
+        return await ws.send_json({"method": "reply", "id": None, "for": None, "error": "expected [method, {data}]"})
+    func = message_handlers.get(method)
+    reply = {"method": "reply", "id": data.get("id"), "for": method}
+    if func is None:
+        reply["error"] = f"unknown method {method!r}"
+    else:
+        try:
+            result = await func(ws, data)
+            if result is None: return
+            reply["result"] = result
+        except QueueApiError as e:
+            reply["error"] = str(e)
+    await ws.send_json(reply)
 
 
 active_socks = {}
 async def websocket_handler(request):
+    ws_id = None
     try:
         # open connection
         ws = aiohttp.web.WebSocketResponse()
         await ws.prepare(request)
         ws_id = hash(ws)
         active_socks[ws_id] = ws
+        # catch the new panel up, then it gets the live batches
+        request.app["log"].attach(ws_id, ws)
         if config.OUTPUT_TO_CONSOLE: print(f'Connection with {request.remote} opened, hash ID {ws_id}')
         # parse messages
         async for msg in ws:
@@ -69,12 +90,89 @@ async def websocket_handler(request):
         await ws.close(code=aiohttp.WSCloseCode.INTERNAL_ERROR)
         ws = None
     finally:
-        del active_socks[ws_id]
+        if ws_id is not None:
+            active_socks.pop(ws_id, None)
+            request.app["log"].detach(ws_id)
     return ws
 
 async def on_server_close(app):
-    for id,sock in active_socks.items():
-        await ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message='Server shutdown')
+    for id,sock in list(active_socks.items()):
+        await sock.close(code=aiohttp.WSCloseCode.GOING_AWAY, message='Server shutdown')
+
+
+
+# QUEUE INSPECTION AND CONTROL
+
+
+# account name -> PostQueue, filled in by Bot
+queues = {}
+
+class QueueApiError(ValueError):
+    """ A bad queue request; the message goes back to the panel. """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def queue_summary(name: str) -> dict:
+    queue = queues[name]
+    return {"account": name, "length": len(queue), "cooldown": queue.get_cooldown(),
+            "paused": queue.paused, "upcoming": queue.upcoming()}
+
+def queue_call(action: str, data: dict) -> dict:
+    """
+    Runs one queue request, for both the REST routes and the websocket.
+    `data` holds "account" and, depending on `action`, "path", "position", "cursor" and "limit".
+    """
+    if not isinstance(data, dict): raise QueueApiError("expected a JSON object")
+    if action == "queues": return {"queues": [queue_summary(name) for name in queues]}
+    name = data.get("account") or next(iter(queues), None)
+    queue = queues.get(name) if isinstance(name, str) else None
+    if queue is None: raise QueueApiError(f"no account {name!r}", 404)
+    if action == "list":
+        try:
+            cursor = int(data["cursor"]) if data.get("cursor") not in (None, "") else None
+            limit = min(max(int(data.get("limit", 50)), 1), 500)
+        except (ValueError, TypeError): raise QueueApiError("cursor and limit must be numbers")
+        items, next_cursor = queue.page(cursor, limit)
+        return dict(queue_summary(name), items=items, next_cursor=next_cursor)
+    if action == "pause": queue.pause()
+    elif action == "resume": queue.resume()
+    elif action in ("remove", "lineup", "pin"):
+        path = data.get("path")
+        if not isinstance(path, str): raise QueueApiError("path must be a string")
+        if path not in queue: raise QueueApiError(f"{path!r} is not queued", 404)
+        if action == "remove":
+            queue.discard(path, "removed from the panel", reason="removed")
+        elif action == "pin":
+            queue.pin(path)
+        else:
+            position = data.get("position")
+            try: position = None if position is None else int(position)
+            except (ValueError, TypeError): raise QueueApiError("position must be a number")
+            queue.line_up(path, position)
+    else: raise QueueApiError(f"unknown action {action!r}")
+    return queue_summary(name)
+
+
+# REST: GET /api/queues, GET /api/queues/<account>?cursor=&limit=, POST /api/queues/<account>/<action>
+async def api_queues(request: web.Request) -> web.Response:
+    return web.json_response(queue_call("queues", {}))
+
+async def api_queue(request: web.Request) -> web.Response:
+    return await __api(request, "list", dict(request.query))
+
+async def api_queue_action(request: web.Request) -> web.Response:
+    try: data = await request.json() if request.can_read_body else {}
+    except ValueError: data = None  # not JSON, turned down by queue_call
+    return await __api(request, request.match_info["action"], data)
+
+async def __api(request, action, data):
+    try:
+        if isinstance(data, dict): data["account"] = request.match_info["account"]
+        # off the event loop, moving files and writing the journal can take a moment
+        return web.json_response(await asyncio.to_thread(queue_call, action, data))
+    except QueueApiError as e:
+        return web.json_response({"error": str(e)}, status=e.status)
 
 
 
@@ -83,20 +181,140 @@ async def on_server_close(app):
 
 # Request Routing
 async def index(request: web.Request) -> web.Response:
-    text = Path('src/webserver/index.html').read_text()
-    return web.Response(text=text, content_type='text/html')
+    # every path that isn't anything else is the panel
+    return request.app["static"].response(request, "index.html")
+
+async def resource(request: web.Request) -> web.Response:
+    return request.app["static"].response(request, "resources/" + request.match_info["name"])
+
+async def metrics(request: web.Request) -> web.Response:
+    """ Counters, gauges and timings from `src.internal.stats`, for Prometheus to scrape. """
+    response = web.Response(text=stats.render_prometheus())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+__ANSI_HTML = {
+    "\033[30m": "</span><span class='colored color_black'>",
+    "\033[31m": "</span><span class='colored color_red'>",
+    "\033[32m": "</span><span class='colored color_green'>",
+    "\033[33m": "</span><span class='colored color_yellow'>",
+    "\033[34m": "</span><span class='colored color_blue'>",
+    "\033[35m": "</span><span class='colored color_purple'>",
+    "\033[36m": "</span><span class='colored color_cyan'>",
+    "\033[37m": "</span><span class='colored color_white'>",
+    "\033[0m":  "</span><span>",
+    # log text goes into the page as html, so it has to be escaped
+    "&": "&amp;", "<": "&lt;", ">": "&gt;",
+}
+__ANSI_PATTERN = re.compile("|".join(re.escape(code) for code in __ANSI_HTML))
+
+def ansi_to_html(s: str) -> str:
+    """ Turns the shell's color codes into spans, in one pass over the string. """
+    return __ANSI_PATTERN.sub(lambda match: __ANSI_HTML[match.group(0)], s)
+
+
+class PanelClient:
+    """
+    One connected panel's outgoing messages: log batches and queue deltas.
+    They wait in a bounded backlog; when a panel can't keep up the oldest are
+    dropped. The next log batch it gets says how many lines it missed, and if
+    queue deltas were dropped it is told to reload the queue. A send that
+    takes longer than `WEBSERVER_SEND_TIMEOUT` disconnects it, and so does
+    any other error while sending. `on_close` is called once it stops.
+    """
+
+    def __init__(self, ws, backlog: int = config.WEBSERVER_CLIENT_BACKLOG, on_close=None):
+        self.ws = ws
+        self.__on_close = on_close
+        self.__backlog = deque(maxlen=max(backlog, 1))
+        self.__skipped = 0
+        self.__resync = False
+        self.__ready = asyncio.Event()
+        self.__task = asyncio.get_running_loop().create_task(self.__sender())
+
+    def push(self, lines: list, **extra) -> None:
+        self.send({"method": "write_batch", "data": lines, **extra})
+
+    def send(self, message: dict) -> None:
+        if len(self.__backlog) == self.__backlog.maxlen:
+            dropped = self.__backlog[0]
+            if dropped["method"] == "write_batch":
+                self.__skipped += len(dropped["data"])
+                stats.incr("weblog_lines_dropped", len(dropped["data"]))
+            else: self.__resync = True
+        self.__backlog.append(message)
+        self.__ready.set()
+
+    async def __sender(self):
+        try:
+            await self.__send_backlog()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # anything else would end this task silently, and the panel would just stop updating
+            if config.OUTPUT_TO_CONSOLE: print("Stopped sending to a panel:", type(e).__name__, e)
+            stats.incr("weblog_clients_dropped")
+            await self.ws.close(code=aiohttp.WSCloseCode.INTERNAL_ERROR, message=b'Server error')
+        finally:
+            if self.__on_close is not None: self.__on_close()
+
+    async def __send_backlog(self):
+        while not self.ws.closed:
+            await self.__ready.wait()
+            self.__ready.clear()
+            while self.__backlog:
+                if self.__resync:
+                    # it missed some changes, so its copy of the queue can't be patched up any more
+                    batch, self.__resync = {"method": "queue_resync"}, False
+                else:
+                    batch = self.__backlog.popleft()
+                    if self.__skipped and batch["method"] == "write_batch":
+                        batch["skipped"], self.__skipped = self.__skipped, 0
+                try:
+                    await asyncio.wait_for(self.ws.send_json(batch), config.WEBSERVER_SEND_TIMEOUT)
+                except (asyncio.TimeoutError, ConnectionError):
+                    stats.incr("weblog_clients_dropped")
+                    await self.ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow')
+                    return
+
+    def close(self) -> None:
+        self.__task.cancel()
+
 
 class WebserverFile(io.StringIO):
-    def __init__(self, port:int = 5000):
+    """
+    The shell's log output, sent to every connected panel.
+
+    Writes only append to a buffer, so logging never waits on the event loop;
+    a flusher on the loop sends whatever came in as one batch at most every
+    `WEBSERVER_FLUSH_SECONDS`. The last `WEBSERVER_LOG_HISTORY` lines are kept
+    so a panel that connects later starts with some context.
+    """
+
+    def __init__(self, port:int = 5000, host:str = "127.0.0.1"):
         super().__init__()
+        self.__history = deque(maxlen=config.WEBSERVER_LOG_HISTORY)
+        self.__pending = []
+        self.__pending_deltas = []
+        self.__partial = ""
+        self.__pending_lock = threading.Lock()
+        self.__clients = {}
+        self.__wake = None
         # server setup
         __app = web.Application()
+        __app["log"] = self
+        __app["static"] = StaticCache('src/webserver/')
         __app.on_shutdown.append(on_server_close)
-        __app.router.add_static('/resources/', path='src/webserver/resources/', name='resources')
+        __app.router.add_get('/resources/{name:.+}', resource, name='resources')
         __app.router.add_get('/ws/app/', websocket_handler)
+        __app.router.add_get('/metrics', metrics)
+        __app.router.add_get('/api/queues', api_queues)
+        __app.router.add_get('/api/queues/{account}', api_queue)
+        __app.router.add_post('/api/queues/{account}/{action}', api_queue_action)
         __app.router.add_get('/{tail:.*}', index)
         self.__server_runner = web.AppRunner(__app)
         # server thread
+        self.host = host
         self.port = port
         self.is_running = False
         self.__event_loop = None
@@ -107,13 +325,15 @@ class WebserverFile(io.StringIO):
         # setup event loop
         self.__event_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.__event_loop)
+        self.__wake = asyncio.Event()
         # initialize server
         self.__event_loop.run_until_complete(self.__server_runner.setup())
         # run server
-        site = web.TCPSite(self.__server_runner, '0.0.0.0', self.port)
+        site = web.TCPSite(self.__server_runner, self.host, self.port)
         self.__event_loop.run_until_complete(site.start())
         print("Started server.")
         self.is_running = True
+        self.__event_loop.create_task(self.__flusher())
         self.__event_loop.run_forever()
         self.is_running = False
     
@@ -123,30 +343,67 @@ class WebserverFile(io.StringIO):
         except AttributeError:
             self.__run_thread = threading.Thread(target=self.__run_thread_func, name="WebServerController-Daemon", daemon=True)
             return self.__run_thread
-    
+
+
+    async def __flusher(self):
+        # anything logged before the loop was up
+        if self.__pending or self.__pending_deltas: self.__wake.set()
+        while True:
+            await self.__wake.wait()
+            # let a burst pile up, so it goes out as one message
+            await asyncio.sleep(config.WEBSERVER_FLUSH_SECONDS)
+            self.__wake.clear()
+            with self.__pending_lock:
+                lines, self.__pending = self.__pending, []
+                deltas, self.__pending_deltas = self.__pending_deltas, []
+            if deltas:
+                # the counts and lineup of the queues that changed, so the panel never has to work them out
+                changed = {delta[0] for delta in deltas}
+                message = {"method": "queue_delta", "events": deltas,
+                           "queues": [queue_summary(name) for name in changed if name in queues]}
+                for client in self.__clients.values(): client.send(message)
+            if lines:
+                for client in self.__clients.values(): client.push(lines)
+
+    def queue_event(self, account: str, event: str, path: str) -> None:
+        """ PostQueue listener: sends the change to the panels with the next batch. """
+        queue = queues.get(account)
+        delta = [account, event, path, queue.seq(path) if queue is not None and event == "add" else None]
+        with self.__pending_lock:
+            woke = not self.__pending and not self.__pending_deltas
+            self.__pending_deltas.append(delta)
+        if woke and self.is_running:
+            self.__event_loop.call_soon_threadsafe(self.__wake.set)
+
+    def attach(self, ws_id, ws) -> None:
+        """ Starts sending log batches to a newly connected panel, beginning with the history. Call on the event loop. """
+        client = self.__clients[ws_id] = PanelClient(ws, on_close=lambda: self.__forget(ws_id, client))
+        with self.__pending_lock:
+            # lines still pending are in the history too, so this doesn't send them twice
+            history = list(self.__history)[:max(len(self.__history) - len(self.__pending), 0)]
+        if history: client.push(history, history=True)
+
+    def detach(self, ws_id) -> None:
+        client = self.__clients.pop(ws_id, None)
+        if client is not None: client.close()
+
+    def __forget(self, ws_id, client) -> None:
+        # a client that stopped on its own; the id may already belong to a newer connection
+        if self.__clients.get(ws_id) is client: del self.__clients[ws_id]
+
     def write(self, s: str, /) -> int:
-        """ Writes a string to all open websockets. Returns the number of websockets written to. """
+        """ Queues a string to be sent to all open websockets. Returns the number of characters written. """
         if s == '': return 0
-        i = 0
-        s = s.replace("\033[30m", "</span><span class='colored color_black'>")\
-             .replace("\033[31m", "</span><span class='colored color_red'>")\
-             .replace("\033[32m", "</span><span class='colored color_green'>")\
-             .replace("\033[33m", "</span><span class='colored color_yellow'>")\
-             .replace("\033[34m", "</span><span class='colored color_blue'>")\
-             .replace("\033[35m", "</span><span class='colored color_purple'>")\
-             .replace("\033[36m", "</span><span class='colored color_cyan'>")\
-             .replace("\033[37m", "</span><span class='colored color_white'>")\
-             .replace("\033[0m",  "</span><span>")
-        if self.is_running:
-            for wsid,socket in active_socks.items():
-                if not socket.closed:
-                    task = socket.send_json({
-                        'method': 'write',
-                        'data': s
-                    })
-                    i += 1
-                    asyncio.run_coroutine_threadsafe(task, self.__event_loop)
-        return i
+        with self.__pending_lock:
+            *lines, self.__partial = (self.__partial + s).split("\n")
+            if not lines: return len(s)
+            lines = [ansi_to_html(line) for line in lines]
+            self.__history.extend(lines)
+            woke = not self.__pending and not self.__pending_deltas
+            self.__pending.extend(lines)
+        if woke and self.is_running:
+            self.__event_loop.call_soon_threadsafe(self.__wake.set)
+        return len(s)
     
     def read(self, *args, **kwargs) -> int:
         raise IOError("This stream cannot be read from!")
@@ -155,10 +412,13 @@ class WebserverFile(io.StringIO):
 
 
 class Bot(StandaloneBot):
-    def __init__(self, shell:Shell=None, client:Client=None):
+    def __init__(self, shell:Shell=None, client=None):
         super().__init__(shell, client)
-        self.__webserver = WebserverFile(port=5000)
+        self.__webserver = WebserverFile(port=config.WEBSERVER_PORT, host=config.WEBSERVER_HOST)
         self.shell.set_log_output_file(self.__webserver)
+        for account in self.accounts:
+            queues[account.username] = account.queue
+            account.queue.add_listener(lambda event, path, name=account.username: self.__webserver.queue_event(name, event, path))
 
 
 
@@ -175,3 +435,13 @@ async def __handle_read(ws, data):
 async def __handle_write(ws, data):
     # print("got write signal!")
     pass
+
+
+# queue_list, queue_remove, queue_lineup, queue_pin, queue_pause, queue_resume and queues; see queue_call
+def __queue_handler(action):
+    async def handler(ws, data):
+        return await asyncio.to_thread(queue_call, action, data)
+    return handler
+
+for __action in ("queues", "list", "remove", "lineup", "pin", "pause", "resume"):
+    add_websocket_handler("queues" if __action == "queues" else "queue_"+__action, __queue_handler(__action))
@@ -0,0 +1,245 @@
+"""one instagram account: its client, queue, cooldowns and post loop"""
+
+import os
+import time
+import threading
+
+from instagrapi import Client, exceptions
+from threadsafe_shell import Shell, get_shell
+
+from src.internal import challenge_solvers as challenges
+from src.internal import stats
+from src.internal import http_transport
+from src.internal.post_queue import PostQueue
+from src.internal.queue_journal import QueueJournal
+from src.internal.scheduler import Scheduler
+from src.internal.upload_stager import UploadStager
+from src.internal.rate_governor import RateGovernor, is_rate_limit
+from src.internal.router import account_path
+
+import src.config as config
+
+
+class Account:
+    """
+    Everything that belongs to a single instagram account: its Client and
+    login, its PostQueue (with journal, rate governor and upload stager) and
+    the loop that posts from it. Several of these can be fed from one sort
+    pipeline.
+    """
+
+    def __init__(self, username: str, password: str, shared: bool = False, folder: str = None, tags: list = (),
+                 scheduler: Scheduler = None, shell: Shell = None, client: Client = None):
+        self.username = username
+        self.password = password
+        self.folder = folder          # drop folder under media/outbound routed to this account, if any
+        self.tags = list(tags)        # tags routed to this account, if any
+        self.shell = get_shell() if shell is None else shell
+        # `shared` means other accounts run in the same process, so their files need telling apart
+        self.session_path = account_path(config.SESSION_SETTINGS_PATH, username, shared)
+        self.started_at = time.time()
+        self.__posted_once = False
+
+        if client is None:
+            self.client = Client()
+            self.client.challenge_code_handler = challenges.challenge_code_handler
+            self.client.change_password_handler = challenges.change_password_handler
+            http_transport.install_on_client(self.client, shell=self.shell)
+            # self.client.handle_exception = challenges.login_exception_handler
+        else: self.client = client
+        self.logged_in = False
+
+        journal_path = account_path(config.QUEUE_JOURNAL_PATH, username, shared)
+        journal = QueueJournal(journal_path) if journal_path else None
+        self.governor = RateGovernor(account_path(config.RATE_STATE_PATH, username, shared), shell=self.shell)
+        self.queue = PostQueue(self.client, shell=self.shell, journal=journal, governor=self.governor)
+        # the bot's scheduler, so a shutdown reaches every account at once
+        self.scheduler = Scheduler() if scheduler is None else scheduler
+        self.queue.add_listener(self.scheduler.notify)
+        self.stager = UploadStager(self.queue, shell=self.shell)
+        self.__thread = None
+        # read when scraped, nothing to keep up to date
+        stats.set_gauge_function("queue_depth", lambda: len(self.queue), account=username)
+        stats.set_gauge_function("cooldown_remaining_seconds", self.queue.get_cooldown, account=username)
+
+
+    def login(self, did_previously_try=False, backed_off=False):
+        """ Logs in this account's Client, reusing the saved session if it is still good. `backed_off` means a rate limit backoff was just waited out. """
+        start = time.time()
+        if not did_previously_try and self.__resume_session():
+            self.shell.success("Resumed saved session for", self.shell.highlight(self.username), "in", self.shell.highlight(f"{time.time()-start:.1f}"), "seconds")
+            stats.observe("login_seconds", time.time()-start, method="session")
+            self.logged_in = True
+            self.save_session()
+            return
+        # after a backoff the wait is already done, waiting for a token at the halved rate on top would count it twice
+        if backed_off: self.governor.take("login")
+        elif not self.governor.acquire("login", self.scheduler.sleep): return
+        self.shell.log("Logging in to account ", self.shell.highlight(self.username), "...", sep="")
+        try:
+            self.client.login(self.username, self.password)
+            self.governor.success("login")
+            self.shell.success("Logged in")
+            stats.observe("login_seconds", time.time()-start, method="password")
+            self.logged_in = True
+            self.save_session()
+        except exceptions.BadPassword:
+            self.shell.error("Bad password. Could not log in at this time.")
+        except Exception as e:
+            if not did_previously_try:
+                if "The username you entered doesn't appear to belong to an account" in str(e):
+                    self.shell.error("Incorrect username; this username does not appear to belong to an account.")
+                elif is_rate_limit(e):
+                    backoff = self.governor.blocked("login", e)
+                    self.shell.warn("Ratelimit 403 received. Waiting", self.shell.highlight(int(backoff)), "seconds to log in again.")
+                    if not self.scheduler.sleep(backoff): return
+                    self.shell.log("Attempting login one more time...")
+                    return self.login(did_previously_try=True, backed_off=True)
+                else:
+                    self.shell.error("Could not log in, with error:", type(e), str(e))
+                self.shell.log("Attempting login one more time...")
+                return self.login(did_previously_try=True)
+            else:
+                self.shell.error("Could not log in, with error:", type(e), str(e))
+                raise
+
+    def __resume_session(self) -> bool:
+        """ Loads the session saved by an earlier login and checks it with a cheap call. """
+        path = self.session_path
+        if not path or not os.path.exists(path): return False
+        self.shell.log("Resuming saved session for ", self.shell.highlight(self.username), "...", sep="")
+        try:
+            self.client.load_settings(path)
+            # with the saved cookies this doesn't send anything, it only restores the user id
+            self.client.login(self.username, self.password)
+            self.client.get_timeline_feed()
+            return True
+        except Exception as e:
+            self.shell.warn("Saved session was rejected, logging in with password:", str(e))
+            # keep the device identity (uuids, device settings, user agent...), so the full login looks like the same phone
+            # again; only what belonged to the rejected session goes
+            settings = self.client.get_settings()
+            settings["cookies"] = {}
+            settings["authorization_data"] = {}
+            self.client.set_settings(settings)
+            return False
+
+    def save_session(self):
+        """ Writes the client's cookies and device settings to this account's session file. """
+        if not self.session_path: return
+        try:
+            tmp = self.session_path + ".tmp"
+            self.client.dump_settings(tmp)
+            os.replace(tmp, self.session_path)
+        except Exception as e:
+            self.shell.warn("Could not save session:", str(e))
+
+
+    def __post_next_in_queue(self):
+        if self.logged_in:
+            if len(self.queue) > 0:
+                album = self.stager.take_album()
+                if not album: return self.shell.log("Nothing to post.")
+                if len(album) == 1: did_error, data = self.queue.post(path=album[0].path, **album[0].kwargs)
+                else: did_error, data = self.queue.post_album([staged.path for staged in album], **UploadStager.album_options(album))
+                if not did_error:
+                    # every file in an album is posted with it, so their captions go too
+                    for staged in album: self.stager.posted(staged)
+                    if not self.__posted_once:
+                        self.__posted_once = True
+                        took = time.time() - self.started_at
+                        stats.set_gauge("time_to_first_post_seconds", took, account=self.username)
+                        self.shell.log("First post", self.shell.highlight(f"{took:.1f}"), "seconds after start.")
+                    self.save_session()
+                if did_error:
+                    self.shell.warn(data)
+                    # some failures are only a message, e.g. "invalid mime type"
+                    if isinstance(data, dict) and is_rate_limit(data.get("exception")):
+                        self.shell.warn("403 received. Backing off and attempting relogin...")
+                        # no logout: that would throw away the session the relogin is about to reuse
+                        # the queue's cooldown is already set to the governor's backoff
+                        if not self.scheduler.sleep(self.queue.get_cooldown()): return
+                        self.shell.log("Attempting re-login.")
+                        stats.incr("relogins", account=self.username)
+                        self.logged_in = False
+                        # login logs its own errors; whatever went wrong, the next slot tries again
+                        try: self.login()
+                        except Exception: pass
+                        if not self.logged_in:
+                            self.shell.warn("Could not log back in. Trying again at the next post slot.")
+                            self.queue.generate_new_cooldown(posted=False)
+                            return
+                        self.shell.success("Successfully relogged. Attempting next post...")
+            else:
+                self.shell.log("Nothing to post.")
+                self.queue.generate_new_cooldown(nothing_to_post=True)
+        else:
+            self.shell.warn("Not logged in. Trying again...")
+            self.login()
+            if not self.logged_in: self.queue.generate_new_cooldown(posted=False)
+
+
+    def post_loop(self):
+        """
+        Until shutdown:
+          a. Wait for posting to be resumed, if it is paused, and for the queue to have something in it
+          b. Post next in queue
+          c. Sleep until the cooldown is over
+
+        Every wait blocks on the scheduler, so an idle account uses no CPU. An
+        error in one post is logged and waited out, it doesn't end the loop.
+        """
+        num_up = 0
+        self.shell.success(f"-- Post loop start ({self.username}) --")
+        self.stager.start()
+        while not self.scheduler.is_shutdown:
+            if self.queue.paused:
+                self.shell.log(self.username+": Posting paused. Waiting to be resumed.", end='\n\n')
+                if not self.scheduler.wait_for(lambda: not self.queue.paused): break
+            if len(self.queue) == 0:
+                self.shell.log(self.username+": Nothing to post. Waiting for files to be sorted.", end='\n\n')
+                if not self.scheduler.wait_for(lambda: len(self.queue) > 0): break
+                # it may have been paused in the meantime
+                continue
+
+            slot_opened = time.monotonic()
+            try:
+                self.__post_next_in_queue()
+            except Exception as e:
+                # this thread is the only one posting for this account, so it has to survive anything
+                self.shell.error(self.username+": Post failed with an unexpected error:", type(e).__name__, str(e))
+                stats.incr("post_loop_errors", account=self.username, error=type(e).__name__)
+                if not self.queue.is_cooldown(): self.queue.generate_new_cooldown(posted=False)
+            if self.queue.upload_started is not None and self.queue.upload_started >= slot_opened:
+                waited = self.queue.upload_started - slot_opened
+                stats.observe("slot_to_upload_seconds", waited, account=self.username)
+                self.shell.debug("Upload started", f"{waited:.3f}", "seconds after the slot opened")
+
+            self.shell.log(self.username+": Num uploaded:", self.shell.highlight(num_up), "Num left in queue:", self.shell.highlight(len(self.queue)))
+            num_up += 1
+
+            if (cool:=self.queue.get_cooldown()):
+                hours, minutes, seconds = cool//3600, (cool//60)%60, cool%60
+                # i do it this way because i would rather see "1h0m47s" than "1h47s"
+                if hours:
+                    timestr = self.shell.highlight(hours) + 'h' + self.shell.highlight(minutes) + 'm' + self.shell.highlight(seconds) + 's'
+                elif minutes:
+                    timestr = self.shell.highlight(minutes) + 'm' + self.shell.highlight(seconds) + 's'
+                else: timestr = self.shell.highlight(seconds) + 's'
+                self.shell.log(self.username+": Sleeping", timestr, "for next post", end='\n\n')
+                self.scheduler.sleep(cool)
+            else:
+                self.shell.log("No post cooldown, or cooldown already passed.", end='\n\n')
+
+    def start(self) -> threading.Thread:
+        """ Runs the post loop on its own thread. """
+        self.__thread = threading.Thread(target=self.post_loop, name=f"PostLoop-{self.username}-Thread")
+        self.__thread.start()
+        return self.__thread
+
+    def stop(self) -> None:
+        """ Waits for the post loop to finish its current upload; the shared scheduler must already be shut down. """
+        self.stager.stop()
+        if self.__thread is not None and self.__thread.is_alive():
+            self.shell.log("Stopping post loop for", self.username+"...")
+            self.__thread.join()
@@ -0,0 +1,153 @@
+"""indexed store of per-file captions and post options"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+from threadsafe_shell import get_shell
+shell = get_shell()
+
+
+def parse_options_line(line: str) -> (str, dict):
+    """
+    Parses one `post_options.txt` line, `<filename> | <caption> --<option> <value> ...`,
+    into its filename and a dict of options. Returns (None, None) if the line isn't one.
+    """
+    if " | " not in line: return None, None
+    key, rest = line.split(" | ", 1)
+    caption, *opts = rest.split(" --")
+    options = {"caption": caption.strip()}
+    for opt in opts:
+        name, _, value = opt.strip().partition(" ")
+        value = value.strip()
+        if name == "latlon":
+            try:
+                lat, lon = value.split(",")
+                options["latlon"] = [float(lat), float(lon)]
+            except ValueError:
+                shell.warn("Captions: bad --latlon", repr(value), "for", key.strip())
+        elif name:
+            # unknown options are kept, so later versions can use them without a re-import
+            options[name] = value
+    return key.strip(), options
+
+
+class CaptionStore:
+    """
+    Captions keyed by filename, in SQLite. Looking one up and consuming it is
+    a single indexed transaction, so posting no longer rewrites a text file,
+    and a crash can at worst leave one caption marked as not yet used.
+
+    `post_options.txt` stays the way to add captions: it is treated as
+    append-only, and only the bytes added since the last import are read.
+    """
+
+    def __init__(self, path: str):
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS captions (
+                key      TEXT PRIMARY KEY,
+                options  TEXT NOT NULL,
+                consumed REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+
+    def put(self, key: str, options: dict, reuse: bool = True) -> None:
+        """
+        Adds or replaces the options for `key`. If the ones there were already
+        used, the new ones are up for use again: drop names get reused, and a
+        new line for one is meant for the next file with it. With `reuse`
+        off that only happens if the options changed, for lines that may just
+        be read again (after the file was edited).
+        """
+        with self.__lock:
+            self.__db.execute("""
+                INSERT INTO captions (key, options) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET options = excluded.options,
+                    consumed = CASE WHEN ? OR options != excluded.options THEN NULL ELSE consumed END
+            """, (key, json.dumps(options), reuse))
+
+    def consume(self, *keys: str) -> dict:
+        """ Returns and marks as used the options of the first of `keys` that has unused ones, or None. """
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN IMMEDIATE")
+                for key in keys:
+                    row = self.__db.execute("SELECT options FROM captions WHERE key = ? AND consumed IS NULL", (key,)).fetchone()
+                    if row is not None:
+                        self.__db.execute("UPDATE captions SET consumed = ? WHERE key = ?", (time.time(), key))
+                        return json.loads(row[0])
+        return None
+
+    def peek(self, *keys: str) -> dict:
+        """ Like `consume`, without marking anything as used. """
+        return self.find(*keys)[1]
+
+    def find(self, *keys: str) -> (str, dict):
+        """ The first of `keys` that has unused options, and those options, without marking them as used. (None, None) if none do. """
+        with self.__lock:
+            for key in keys:
+                row = self.__db.execute("SELECT options FROM captions WHERE key = ? AND consumed IS NULL", (key,)).fetchone()
+                if row is not None: return key, json.loads(row[0])
+        return None, None
+
+
+    def import_text(self, path: str) -> int:
+        """
+        Imports lines appended to a `post_options.txt` style file since the
+        last import (the first line is a header). If the file shrank it was
+        edited, so it is read again from the top. Returns the number of lines imported.
+        """
+        try: stat = os.stat(path)
+        except OSError: return 0
+        size = stat.st_size
+        with self.__lock:
+            row = self.__db.execute("SELECT value FROM meta WHERE key = ?", ("offset:"+path,)).fetchone()
+        offset = int(row[0]) if row else 0
+        if size == offset: return 0
+        if size < offset: offset = 0
+        with open(path, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+        # only take whole lines, a half-written last line is picked up next time.
+        # a last line nobody has touched in a while just didn't get a newline
+        settled = time.time() - stat.st_mtime > 2
+        end = len(data) if settled else data.rfind(b'\n') + 1
+        lines = data[:end].decode().split('\n')
+        # read from the top, lines that were there before come round again, and mustn't bring used captions back
+        appended = offset > 0
+        if offset == 0: lines = lines[1:]  # header
+        count = 0
+        for line in lines:
+            key, options = parse_options_line(line)
+            if key is None: continue
+            self.put(key, options, reuse=appended)
+            count += 1
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("offset:"+path, str(offset + end)))
+        return count
+
+    def __len__(self) -> int:
+        """ Number of captions not used yet. """
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM captions WHERE consumed IS NULL").fetchone()[0]
+
+
+if __name__ == "__main__":
+    # python3 -m src.internal.caption_store <store.sqlite3> <post_options.txt>
+    if len(sys.argv) != 3:
+        print("usage: python3 -m src.internal.caption_store <store.sqlite3> <post_options.txt>")
+        sys.exit(1)
+    store = CaptionStore(sys.argv[1])
+    print("Imported", store.import_text(sys.argv[2]), "captions,", len(store), "unused in total.")
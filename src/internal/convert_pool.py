@@ -0,0 +1,100 @@
+"""runs conversions for the sort stage in parallel"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.internal import file_io as fileio
+from src.internal import stats
+from src.internal.router import Router
+from src.internal.dedup_index import DedupIndex
+from src.internal.outbound_gate import OutboundGate
+from src.config import (
+    CONVERT_WORKERS, CONVERT_MAX_IMAGE, CONVERT_MAX_VIDEO
+)
+
+from threadsafe_shell import Shell, get_shell
+
+
+class ConvertPool:
+    """
+    Bounded pool of conversion workers feeding the PostQueues behind a Router.
+
+    Images and videos get their own executors so a pile of slow video encodes
+    can't starve the images (and the other way around); `workers` caps how
+    many conversions run at once overall. The work itself is done by
+    `mogrify`/`ffmpeg` subprocesses, so threads are enough here.
+
+    With a `gate`, every finished file is reported back to it: anything still
+    sitting in `media/outbound` afterwards wasn't usable.
+    """
+
+    def __init__(self, router: Router, lock: threading.Lock = None, workers: int = CONVERT_WORKERS,
+                 max_image: int = CONVERT_MAX_IMAGE, max_video: int = CONVERT_MAX_VIDEO,
+                 dedup: DedupIndex = None, gate: OutboundGate = None, shell: Shell = None):
+        self.router = router
+        self.lock = lock
+        self.dedup = dedup
+        self.gate = gate
+        self.shell = get_shell() if shell is None else shell
+        self.__slots = threading.BoundedSemaphore(max(workers, 1))
+        self.__executors = {
+            "image": ThreadPoolExecutor(max_workers=max(min(max_image, workers), 1), thread_name_prefix="ConvertImage-Worker"),
+            "video": ThreadPoolExecutor(max_workers=max(min(max_video, workers), 1), thread_name_prefix="ConvertVideo-Worker"),
+        }
+        # paths submitted but not finished yet, so a rescan doesn't submit them twice
+        self.__pending = set()
+        self.__pending_lock = threading.Lock()
+
+
+    def submit(self, path: str) -> bool:
+        """ Queues a file for conversion. Returns False if it was rejected or is already being converted. """
+        with self.__pending_lock:
+            if path in self.__pending: return False
+            self.__pending.add(path)
+        try:
+            mime = fileio.sniff(path)
+        except Exception as e:
+            self.shell.warn("Sort: Could not read file", path, "-", str(e))
+            stats.incr("files_discovered", type="unreadable")
+            self.__done(path)
+            return False
+        stats.incr("files_discovered", type=mime[0])
+        executor = self.__executors.get(mime[0])
+        if executor is None:
+            # let convert_and_sort do the rejecting, so it's logged the same way as always
+            # (it never reaches a queue, so no need to spend a routing turn on it)
+            fileio.convert_and_sort(self.router.queues[0], path, lock=self.lock, mime=mime, dedup=self.dedup)
+            self.__done(path)
+            return False
+        executor.submit(self.__convert, path, mime)
+        return True
+
+    def __convert(self, path, mime):
+        try:
+            with self.__slots:
+                fileio.convert_and_sort(self.router.route(path), path, lock=self.lock, mime=mime, dedup=self.dedup)
+        except Exception as e:
+            self.shell.error("Sort: Error converting", path, "-", type(e), str(e))
+        finally:
+            self.__done(path)
+
+    def __done(self, path):
+        if self.gate is not None:
+            # converted, discarded and duplicate files are all moved out; whatever is left was turned down
+            if os.path.exists(path): self.gate.rejected(path)
+            else: self.gate.accepted(path)
+        with self.__pending_lock:
+            self.__pending.discard(path)
+            drained = not self.__pending
+        if drained: self.shell.log("Sort:", self.shell.highlight(len(self.router)), "files in queue.", end='\n\n')
+
+
+    def pending(self) -> int:
+        """ Number of files submitted and not finished yet. """
+        with self.__pending_lock:
+            return len(self.__pending)
+
+    def shutdown(self, wait: bool = True) -> None:
+        for executor in self.__executors.values():
+            executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,214 @@
+"""remembers media already seen, to catch reposts under a new name"""
+
+import io
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+import subprocess
+
+from PIL import Image
+
+from src.internal import media_probe
+
+from threadsafe_shell import get_shell
+shell = get_shell()
+
+# 32x32 DCT, keeping the 8x8 lowest frequencies -> 64 bit hash
+__DCT_SIZE = 32
+__HASH_SIZE = 8
+__COS = [[math.cos(math.pi * (2*x + 1) * u / (2*__DCT_SIZE)) for x in range(__DCT_SIZE)] for u in range(__HASH_SIZE)]
+
+
+def content_hash(path: str) -> str:
+    """ sha256 of the file's bytes. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_phash(image: Image.Image) -> int:
+    """ DCT perceptual hash of an image: similar-looking images get hashes a small Hamming distance apart. """
+    pixels = list(image.convert("L").resize((__DCT_SIZE, __DCT_SIZE), Image.LANCZOS).getdata())
+    rows = [pixels[y*__DCT_SIZE:(y+1)*__DCT_SIZE] for y in range(__DCT_SIZE)]
+    # separable 2D DCT-II, only computing the low frequencies we keep
+    partial = [[sum(c*p for c,p in zip(cos, row)) for cos in __COS] for row in rows]
+    coeffs = [sum(__COS[v][y] * partial[y][u] for y in range(__DCT_SIZE)) for v in range(__HASH_SIZE) for u in range(__HASH_SIZE)]
+    # the DC term is just overall brightness, leave it out of the median
+    median = sorted(coeffs[1:])[len(coeffs[1:])//2]
+    bits = 0
+    for c in coeffs:
+        bits = (bits << 1) | (c > median)
+    return bits
+
+
+def video_phash(path: str, info: dict = None) -> int:
+    """ Perceptual hash of the frame halfway through a video, or None if no frame could be read. `info` saves probing it again. """
+    info = media_probe.probe(path) if info is None else info
+    at = (info["duration"] or 0) / 2 if info is not None else 0
+    try:
+        frame = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-ss", str(at), "-i", path,
+             "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+            check=True, capture_output=True
+        ).stdout
+        with Image.open(io.BytesIO(frame)) as image:
+            return image_phash(image)
+    except (subprocess.CalledProcessError, OSError) as e:
+        shell.debug("Dedup: could not grab a frame from", path, "-", str(e))
+        return None
+
+
+def phash(path: str, typ: str, info: dict = None) -> int:
+    """ Perceptual hash of an image or video file (with its probe result in `info`, if there is one), or None if it couldn't be computed. """
+    if typ == "video": return video_phash(path, info)
+    try:
+        with Image.open(path) as image:
+            return image_phash(image)
+    except OSError as e:
+        shell.debug("Dedup: could not hash", path, "-", str(e))
+        return None
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """
+    Multi-index hashing over 64 bit hashes. Every hash is split into
+    `max_distance + 1` bands, each with an exact-match dict; by the
+    pigeonhole principle a hash within `max_distance` of the query matches it
+    exactly in at least one band, so a search only looks at the few entries
+    sharing a band with it and checks their real distance.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        count = min(max(max_distance + 1, 1), 64)
+        # (shift, mask) per band, the first few a bit wider when 64 doesn't divide evenly
+        self.__bands = []
+        shift = 0
+        for i in range(count):
+            width = 64 // count + (i < 64 % count)
+            self.__bands.append((shift, (1 << width) - 1))
+            shift += width
+        # per band: band value -> {value: hash}
+        self.__tables = [{} for _ in self.__bands]
+        self.__len = 0
+
+    def add(self, hash: int, value) -> None:
+        for (shift, mask), table in zip(self.__bands, self.__tables):
+            table.setdefault((hash >> shift) & mask, {})[value] = hash
+        self.__len += 1
+
+    def remove(self, hash: int, value) -> None:
+        for (shift, mask), table in zip(self.__bands, self.__tables):
+            key = (hash >> shift) & mask
+            bucket = table.get(key)
+            if bucket is None or bucket.pop(value, None) is None: return
+            if not bucket: del table[key]
+        self.__len -= 1
+
+    def find(self, hash: int):
+        """ Returns (distance, value) of the closest entry within `max_distance`, or None. """
+        best = None
+        for (shift, mask), table in zip(self.__bands, self.__tables):
+            bucket = table.get((hash >> shift) & mask)
+            if not bucket: continue
+            # an entry sharing several bands gets checked more than once, still cheaper than keeping track
+            for value, other in bucket.items():
+                d = (hash ^ other).bit_count()
+                if d <= self.max_distance and (best is None or d < best[0]):
+                    best = (d, value)
+                    if d == 0: return best
+        return best
+
+    def __len__(self) -> int:
+        return self.__len
+
+
+class DedupIndex:
+    """
+    Persistent index of content hashes and perceptual hashes of everything
+    that has been sorted. The exact hashes are looked up in SQLite, the
+    perceptual ones in an in-memory HashIndex rebuilt from SQLite on startup.
+    """
+
+    class Duplicate:
+        def __init__(self, kind, path, distance=0):
+            self.kind = kind          # "exact" or "similar"
+            self.path = path          # what it duplicates
+            self.distance = distance  # Hamming distance of the perceptual hashes
+
+    def __init__(self, path: str, max_distance: int):
+        self.max_distance = max_distance
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+                sha256 TEXT PRIMARY KEY,
+                phash  INTEGER,
+                type   TEXT,
+                path   TEXT,
+                added  REAL NOT NULL
+            )
+        """)
+        self.__hashes = {"image": HashIndex(max_distance), "video": HashIndex(max_distance)}
+        for sha,ph,typ in self.__db.execute("SELECT sha256, phash, type FROM media WHERE phash IS NOT NULL"):
+            # sqlite integers are signed 64 bit
+            self.__hashes[typ].add(ph & 0xFFFFFFFFFFFFFFFF, sha)
+
+
+    def claim(self, path: str, typ: str, info: dict = None):
+        """
+        Checks `path` against the index. If it is new it is recorded (under
+        its current path, see `update_path`) and the return is (sha256, None);
+        otherwise (sha256, DedupIndex.Duplicate). `info` is a video's probe
+        result, if it was already probed.
+        """
+        sha = content_hash(path)
+        with self.__lock:
+            row = self.__db.execute("SELECT path FROM media WHERE sha256 = ?", (sha,)).fetchone()
+        if row is not None: return sha, self.__class__.Duplicate("exact", row[0])
+        ph = phash(path, typ, info) if self.max_distance >= 0 else None
+        with self.__lock:
+            # check again, someone may have claimed the same bytes while we were hashing
+            row = self.__db.execute("SELECT path FROM media WHERE sha256 = ?", (sha,)).fetchone()
+            if row is not None: return sha, self.__class__.Duplicate("exact", row[0])
+            if ph is not None:
+                found = self.__hashes[typ].find(ph)
+                if found is not None:
+                    row = self.__db.execute("SELECT path FROM media WHERE sha256 = ?", (found[1],)).fetchone()
+                    return sha, self.__class__.Duplicate("similar", row[0] if row else None, found[0])
+                self.__hashes[typ].add(ph, sha)
+            signed = None if ph is None else ph - (1 << 64) if ph >= (1 << 63) else ph
+            self.__db.execute("INSERT INTO media (sha256, phash, type, path, added) VALUES (?, ?, ?, ?, ?)",
+                              (sha, signed, typ, path, time.time()))
+        return sha, None
+
+    def update_path(self, sha: str, path: str) -> None:
+        """ Points an entry at where its file ended up. """
+        with self.__lock:
+            self.__db.execute("UPDATE media SET path = ? WHERE sha256 = ?", (path, sha))
+
+    def rename_path(self, path: str, new_path: str) -> None:
+        """ Points the entry for a file at where it was moved, if there is one. """
+        with self.__lock:
+            self.__db.execute("UPDATE media SET path = ? WHERE path = ?", (new_path, path))
+
+    def release(self, sha: str) -> None:
+        """ Forgets a claimed file that never made it into the queue, so it can be tried again. """
+        with self.__lock:
+            row = self.__db.execute("SELECT phash, type FROM media WHERE sha256 = ?", (sha,)).fetchone()
+            if row is not None and row[0] is not None: self.__hashes[row[1]].remove(row[0] & 0xFFFFFFFFFFFFFFFF, sha)
+            self.__db.execute("DELETE FROM media WHERE sha256 = ?", (sha,))
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM media").fetchone()[0]
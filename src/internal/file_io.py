@@ -1,17 +1,144 @@
 import sys
 import os
-import magic
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from contextlib import nullcontext
 
-from instagrapi.types import Location
+from PIL import Image, ImageOps, UnidentifiedImageError
 
 from src.internal.post_queue import PostQueue
-from src.config import PERMANENT_HASHTAGS
+from src.internal import stats
+from src.internal import media_probe
+from src.internal import media_fit
+from src.internal import media_layout
+from src.internal.dedup_index import DedupIndex
+from src.internal.caption_store import CaptionStore
+from src.config import (
+    PERMANENT_HASHTAGS, POST_OPTIONS_PATH, CAPTION_STORE_PATH, JPEG_QUALITY, VIDEO_PRESET, VIDEO_CRF, VIDEO_MAX_DIMENSION,
+    OPTIMIZE_MEDIA, OPTIMIZE_MAX_WIDTH, OPTIMIZE_JPEG_QUALITY, OPTIMIZE_VIDEO_MAX_KBPS
+)
 
 from threadsafe_shell import get_shell
 shell = get_shell()
 
-def change_file_type(path):
+def sniff(path) -> (str, str):
+    """ Returns the (type, subtype) of the file's MIME type, e.g. ("image", "png"). """
+    # loads libmagic, so only once there's a file to look at
+    import magic
     typ,ext = magic.from_file(path, mime=True).split("/")
+    return typ, ext
+
+
+def place_sorted(tmp_path, fmt, lock=None) -> str:
+    """ Moves a converted file into its shard of `media/sorted/<fmt>/` under a new id. Returns the new path. """
+    new_path = reserve_sorted(fmt, lock)
+    os.rename(tmp_path, new_path)
+    return new_path
+
+
+def reserve_sorted(fmt, lock=None) -> str:
+    """ Claims a new id in `media/sorted/<fmt>/` by creating its file empty, for writers that fill it in place. """
+    while True:
+        new_path = media_layout.sorted_path(fmt)
+        with (nullcontext() if lock is None else lock):
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.close(os.open(new_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return new_path
+        except FileExistsError:
+            # one in 2^64, but it costs nothing to make sure
+            continue
+
+
+def transcode_image(path, out_path) -> None:
+    """
+    Decodes any image Pillow understands, fits it into the allowed aspect
+    ratios and writes it to `out_path` as an RGB JPEG (only the pixels, no
+    exif). With OPTIMIZE_MEDIA it's also scaled down to OPTIMIZE_MAX_WIDTH.
+    Raises MediaRejected if it can't be made postable.
+    """
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)  # bake in the rotation, the exif is dropped
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            # jpg has no alpha; flatten onto white instead of letting the transparent bits go black
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image = media_fit.fit_image(image)
+        if not OPTIMIZE_MEDIA:
+            image.save(out_path, format="JPEG", quality=JPEG_QUALITY)
+            return
+        if image.width > OPTIMIZE_MAX_WIDTH:
+            image = image.resize((OPTIMIZE_MAX_WIDTH, round(image.height * OPTIMIZE_MAX_WIDTH / image.width)), Image.LANCZOS)
+        # pillow carries jpeg comments over unless told otherwise
+        image.save(out_path, format="JPEG", quality=OPTIMIZE_JPEG_QUALITY, optimize=True, comment=b"")
+
+
+def __ffmpeg(*args) -> None:
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True)
+
+def transcode_video(path, out_path, info=None) -> str:
+    """
+    Writes `path` to `out_path` as an instagram-friendly mp4. Returns "remux"
+    if the streams could be copied over as they are, or "reencode". Raises
+    MediaRejected if it can't be made postable. `info` is its probe result,
+    if it was already probed.
+
+    With OPTIMIZE_MEDIA, videos wider than OPTIMIZE_MAX_WIDTH or above
+    OPTIMIZE_VIDEO_MAX_KBPS are re-encoded down to them, and metadata is
+    left out either way.
+    """
+    info = media_probe.probe(path) if info is None else info
+    reason = media_probe.incompatibility(info)
+    fit = media_fit.video_filter(info)
+    if reason is None and fit is not None: reason = "aspect ratio: " + fit
+    if reason is None and OPTIMIZE_MEDIA:
+        if info["width"] > OPTIMIZE_MAX_WIDTH: reason = f"optimize: width {info['width']}"
+        elif (info.get("bit_rate") or 0) > OPTIMIZE_VIDEO_MAX_KBPS*1000: reason = f"optimize: {info['bit_rate']//1000}kbps"
+    strip = ["-map_metadata", "-1", "-map_chapters", "-1"] if OPTIMIZE_MEDIA else []
+    if reason is None:
+        try:
+            # already h264/aac, just swap the container and move the index to the front
+            __ffmpeg("-i", path, "-map", "0:v:0", "-map", "0:a:0?", *strip, "-c", "copy", "-movflags", "+faststart", out_path)
+            media_probe.record(path, info, "remux")
+            return "remux"
+        except subprocess.CalledProcessError as e:
+            reason = f"remux failed: {e}"
+    shell.debug("Re-encoding", path, "-", reason)
+    max_width = min(VIDEO_MAX_DIMENSION, OPTIMIZE_MAX_WIDTH) if OPTIMIZE_MEDIA else VIDEO_MAX_DIMENSION
+    # crf still decides the quality, the cap only kicks in on busy scenes
+    bitrate = ["-maxrate", f"{OPTIMIZE_VIDEO_MAX_KBPS}k", "-bufsize", f"{2*OPTIMIZE_VIDEO_MAX_KBPS}k"] if OPTIMIZE_MEDIA else []
+    __ffmpeg(
+        "-i", path, "-map", "0:v:0", "-map", "0:a:0?", *strip,
+        "-c:v", "libx264", "-preset", VIDEO_PRESET, "-crf", str(VIDEO_CRF), *bitrate, "-pix_fmt", "yuv420p",
+        # libx264 wants even dimensions, and anything past VIDEO_MAX_DIMENSION (or the optimized width) gets shrunk
+        "-vf", ("" if fit is None else fit+",") +
+               f"scale='min({max_width},iw)':'min({VIDEO_MAX_DIMENSION},ih)':force_original_aspect_ratio=decrease:force_divisible_by=2",
+        "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", out_path
+    )
+    media_probe.record(path, info, "reencode", reason)
+    return "reencode"
+
+
+def change_file_type(path, lock=None, mime=None, info=None):
+    """
+    Converts a file to jpg/mp4 and moves it into `media/sorted/`, named by a
+    new id (see `media_layout`).
+
+    Images are decoded and written straight into their reserved spot in
+    `media/sorted/jpg/` by Pillow. Videos, and images Pillow can't read, are
+    converted into their own folder under `media/tmp/` and renamed in; videos
+    that are already h264/aac are only remuxed, not re-encoded. Either
+    way `lock` is only held while making shard folders, so several
+    conversions can run at once. `info` is a video's probe result, if it
+    was already probed.
+    """
+    typ,ext = sniff(path) if mime is None else mime
     folder, filename, fileext = PostQueue.parse_path(path)
     
     if typ == "image":   fmt = "jpg"
@@ -20,59 +147,165 @@ def change_file_type(path):
     # just in case
     if ext == "gif": return False, {"type": typ, "ext": ext}
     
-    new_path = f"media/sorted/{fmt}/{filename}.{fmt}"
-    i = 1
-    while os.path.exists(new_path):
-        new_path = f"media/sorted/{fmt}/{filename}-{i}.{fmt}"
-        i += 1
+    new_path = None
     if typ == "image":
-        os.system(f"mogrify -format {fmt} '{path}'")
-        os.rename(folder+"/"+filename+"."+fmt, new_path)
-        try: os.remove(path)
-        except: pass
-    else:
-        os.system(f"ffmpeg -hide_banner -loglevel error -y -i '{path}' '{new_path}'")
-        os.remove(path)
+        new_path = reserve_sorted(fmt, lock)
+        done = False
+        try:
+            transcode_image(path, new_path)
+            done = True
+        except media_fit.MediaRejected as e:
+            return False, {"type": typ, "ext": ext, "rejected": str(e)}
+        except (UnidentifiedImageError, OSError) as e:
+            # unusual formats (svg, heic...) still go through imagemagick below
+            shell.debug("Pillow could not convert", path, "-", str(e), "- falling back to mogrify")
+        finally:
+            # whatever went wrong, an empty or half-written file mustn't be left where the next scan would queue it
+            if not done:
+                os.remove(new_path)
+                new_path = None
+    if new_path is None:
+        work_dir = tempfile.mkdtemp(dir="media/tmp")
+        try:
+            tmp_path = f"{work_dir}/{filename}.{fmt}"
+            if typ == "image":
+                subprocess.run(["mogrify", "-path", work_dir, "-format", fmt, path], check=True)
+                # pillow can read what mogrify wrote, so it can do the fitting
+                transcode_image(tmp_path, work_dir+"/fitted.jpg")
+                tmp_path = work_dir+"/fitted.jpg"
+            else:
+                transcode_video(path, tmp_path, info)
+            new_path = place_sorted(tmp_path, fmt, lock)
+        except media_fit.MediaRejected as e:
+            return False, {"type": typ, "ext": ext, "rejected": str(e)}
+        except (subprocess.CalledProcessError, OSError) as e:
+            return False, {"type": typ, "ext": ext, "error": str(e)}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    try: os.remove(path)
+    except: pass
     return True, {"type": typ, "ext": ext, "path": new_path}
 
 
-def convert_and_sort(queue: PostQueue, path: str, comment: str = "", tags=[], ):
+def discard_source(path, reason: str) -> str:
+    """ Moves an outbound file that won't be posted into its shard of `media/discard/<reason>/`. Returns the new path. """
+    return media_layout.move(path, media_layout.discard_path(path, reason))
+
+
+def convert_and_sort(queue: PostQueue, path: str, comment: str = "", tags=[], lock=None, mime=None, dedup: DedupIndex = None):
     global shell
     shell.debug("Sorting file", path)
-    good, res = change_file_type(path)
+    sha = None
+    info = None
+    if dedup is not None:
+        typ,ext = mime = sniff(path) if mime is None else mime
+        if typ in ("image", "video") and ext != "gif":
+            # probed once here, for both the hash and the conversion
+            if typ == "video": info = media_probe.probe(path)
+            # before any conversion work, that's the whole point
+            sha, dup = dedup.claim(path, typ, info)
+            if dup is not None:
+                stats.incr("files_converted", type=typ, outcome="duplicate")
+                moved = discard_source(path, "duplicate")
+                shell.warn("Not posting file", path, "-", "exact" if dup.kind == "exact" else f"near (distance {dup.distance})",
+                           "duplicate of", dup.path, "- moved to", moved)
+                return False
+    start = time.perf_counter()
+    # the source is gone once it's converted
+    source_bytes = os.path.getsize(path) if OPTIMIZE_MEDIA else None
+    try:
+        good, res = change_file_type(path, lock, mime, info)
+    except Exception:
+        if sha is not None: dedup.release(sha)
+        stats.incr("files_converted", type=mime[0] if mime else "unknown", outcome="error")
+        raise
     if good:
+        outcome = "converted"
         shell.log("Converted file", path, "to", res["path"])
-        queue.add(res["path"])
+        if sha is not None: dedup.update_path(sha, res["path"])
+        if source_bytes is not None:
+            sorted_bytes = os.path.getsize(res["path"])
+            stats.incr("optimize_bytes_saved", max(source_bytes - sorted_bytes, 0), type=res["type"])
+            shell.log("Optimized", res["path"], "-", f"{source_bytes/1e6:.2f} MB ->", f"{sorted_bytes/1e6:.2f} MB,",
+                      shell.highlight(f"{(source_bytes - sorted_bytes)/1e6:.2f}"), "MB saved")
+        # the sorted file is named by its id, captions are still looked up by the name it came in with
+        queue.add(res["path"], source_bytes=source_bytes, source_name=os.path.basename(path))
     else:
-        shell.warn("Cannot post file", path, "- bad or unknown MIME type", res["type"]+"/"+res["ext"])
+        if sha is not None: dedup.release(sha)
+        if "rejected" in res:
+            outcome = "rejected"
+            moved = discard_source(path, "rejected")
+            shell.warn("Cannot post file", path, "-", res["rejected"], "- moved to", moved)
+        elif "error" in res:
+            outcome = "error"
+            shell.warn("Could not convert file", path, "-", res["error"])
+        else:
+            outcome = "unsupported"
+            shell.warn("Cannot post file", path, "- bad or unknown MIME type", res["type"]+"/"+res["ext"])
+    stats.incr("files_converted", type=res["type"], outcome=outcome)
+    if outcome != "unsupported": stats.observe("convert_seconds", time.perf_counter() - start, type=res["type"])
     return good
 
 
-def get_next_options(filename:str) -> dict:
-    with open("src/post_options.txt", "r") as file:
-        # read data
-        lines = file.read().split('\n')
-    returnval = ""
-    with open("src/post_options.txt", "w") as file:
-        file.truncate()  # clear file
-        # write back all but first line
-        file.write(lines[0])  # header
-        if len(lines) > 1:
-            for line in lines[1:]:
-                if line.startswith(filename + " | "): returnval = line
-                else: file.write('\n' + line)
-    # parse data
-    if len(lines) <= 1 or returnval == "": return {"caption": PERMANENT_HASHTAGS}  # no more lines except header
-    ## TODO parse data below
-    # opts = lines[0].split("--")
-    # dic = {"caption": opts.pop(0)}
-    # for opt in opts:
-    #     a,b = opt.split()
-    #     if a == "latlon":
-    #         lat,lon = b.split(',')
-    #         dic["location"] = 
-    # print(opts)
-    
-    ## for now just return caption, until parsing is functional
-    returnval = returnval.split(" | ")[1]
-    return {"caption": returnval.split(" --")[0].strip() + '\n' + PERMANENT_HASHTAGS}
\ No newline at end of file
+__captions = None
+__captions_lock = threading.Lock()
+
+def get_caption_store() -> CaptionStore:
+    """ The shared caption store, opened on first use. """
+    global __captions
+    with __captions_lock:
+        if __captions is None:
+            __captions = CaptionStore(CAPTION_STORE_PATH)
+        return __captions
+
+
+def build_post_options(options: dict) -> dict:
+    """ Turns stored caption options (None if there were none) into keyword arguments for `PostQueue.post`. """
+    if options is None: return {"caption": PERMANENT_HASHTAGS}
+    kwargs = {"caption": options.get("caption", "").strip() + '\n' + PERMANENT_HASHTAGS}
+    if "latlon" in options:
+        lat, lon = options["latlon"]
+        # instagrapi looks up the venue at these coordinates when uploading
+        # (imported here, building captions is the only thing in this module that needs instagrapi)
+        from instagrapi.types import Location
+        kwargs["location"] = Location(name="", lat=lat, lng=lon)
+    return kwargs
+
+
+def option_keys(filename:str, source_name:str = None) -> list:
+    """
+    Keys a file's options may be stored under, best first. `source_name` is
+    the name it was dropped into `media/outbound` with (see
+    `PostQueue.source_name`), which is what captions are written for.
+    """
+    folder, name, ext = PostQueue.parse_path(filename)
+    keys = [filename]
+    if source_name:
+        stem = os.path.splitext(source_name)[0]
+        # the flat layout's sorted path, which older `post_options.txt` lines are keyed by
+        keys += [f"media/sorted/{ext}/{stem}.{ext}", source_name, stem+"."+ext, stem]
+    return keys + [name+"."+ext, name]
+
+def find_options(filename:str, source_name:str = None) -> (str, dict):
+    """
+    Looks up the stored options for a file without using them up, picking up
+    new lines in `post_options.txt` first. Returns the key they were found
+    under (for `use_options`) and the options, (None, None) if it has none.
+    """
+    store = get_caption_store()
+    store.import_text(POST_OPTIONS_PATH)
+    return store.find(*option_keys(filename, source_name))
+
+def use_options(key:str) -> None:
+    """ Marks the options found under `key` by `find_options` as used. """
+    get_caption_store().consume(key)
+
+def consume_options(filename:str, source_name:str = None) -> dict:
+    """ Looks up and uses up the stored options for a file, picking up new lines in `post_options.txt` first. None if it has none. """
+    store = get_caption_store()
+    store.import_text(POST_OPTIONS_PATH)
+    return store.consume(*option_keys(filename, source_name))
+
+def get_next_options(filename:str, source_name:str = None) -> dict:
+    """ Looks up and uses up the caption and options for a file, as keyword arguments for `PostQueue.post`. """
+    return build_post_options(consume_options(filename, source_name))
@@ -0,0 +1,138 @@
+"""pooled, timed HTTP transport for the instagram client's sessions"""
+
+import re
+import time
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from src.internal import stats
+from src.config import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_SIZE, HTTP_RETRIES
+
+from threadsafe_shell import Shell, get_shell
+
+
+# methods that can safely be sent twice; the rest are only retried if they never reached the server
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# seconds spent opening connections (dns + tcp + tls) during the request being sent on this thread
+connect_timings = threading.local()
+
+
+def endpoint(url: str) -> str:
+    """ Label for a URL's endpoint: its path, with ids and upload names blanked so there's one per kind of call. """
+    path = urlsplit(url).path or "/"
+    # ids and upload names start with a digit; `v1` and the like don't
+    return "/".join(":id" if re.match(r"\d", segment) or len(segment) > 32 else segment for segment in path.split("/"))
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        connect_timings.seconds = getattr(connect_timings, "seconds", 0) + time.perf_counter() - start
+        stats.incr("http_connections", host=self.host)
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        connect_timings.seconds = getattr(connect_timings, "seconds", 0) + time.perf_counter() - start
+        stats.incr("http_connections", host=self.host)
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """
+    A requests transport with a keep-alive connection pool, default connect
+    and read timeouts (instagrapi doesn't pass any), and retries: failed
+    connections are always retried, 5xx responses and read errors only for
+    idempotent methods, so an upload is never sent twice.
+
+    Every request is recorded in stats by endpoint: how long it took split
+    into opening a connection, waiting for the response (sending the body and
+    the server working on it) and reading it back, plus bytes each way,
+    status codes and retries.
+    """
+
+    def __init__(self, connect_timeout: float = HTTP_CONNECT_TIMEOUT, read_timeout: float = HTTP_READ_TIMEOUT,
+                 pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES, shell: Shell = None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.shell = get_shell() if shell is None else shell
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.5,
+                      status_forcelist=RETRY_STATUSES, allowed_methods=IDEMPOTENT_METHODS,
+                      raise_on_status=False, respect_retry_after_header=True)
+        super().__init__(pool_connections=4, pool_maxsize=max(pool_size, 1), max_retries=retry)
+
+    def init_poolmanager(self, *args, **kwargs):
+        # keepalive probes, so a connection idle through a long cooldown isn't found dead by the next upload
+        kwargs.setdefault("socket_options", HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        name = endpoint(request.url)
+        sent = self.__body_size(request)
+        connect_timings.seconds = 0
+        start = time.perf_counter()
+        try:
+            response = super().send(request, stream=stream, timeout=self.timeout if timeout is None else timeout, **kwargs)
+            waited = time.perf_counter() - start
+            # what the session would do right after anyway, done here so it can be timed
+            received = len(response.content) if not stream else int(response.headers.get("Content-Length") or 0)
+        except Exception as e:
+            stats.incr("http_requests", endpoint=name, method=request.method, status=type(e).__name__)
+            stats.observe("http_request_seconds", time.perf_counter() - start, endpoint=name)
+            self.shell.debug("HTTP", request.method, name, "failed after", f"{time.perf_counter() - start:.2f}s", "-", type(e).__name__)
+            raise
+        total = time.perf_counter() - start
+        connect = connect_timings.seconds
+        retries = response.raw.retries.history if response.raw is not None and response.raw.retries is not None else ()
+        stats.incr("http_requests", endpoint=name, method=request.method, status=str(response.status_code))
+        stats.incr("http_sent_bytes", sent, endpoint=name)
+        stats.incr("http_received_bytes", received, endpoint=name)
+        if retries: stats.incr("http_retries", len(retries), endpoint=name)
+        stats.observe("http_request_seconds", total, endpoint=name)
+        stats.observe("http_phase_seconds", connect, endpoint=name, phase="connect")
+        stats.observe("http_phase_seconds", max(waited - connect, 0), endpoint=name, phase="wait")
+        stats.observe("http_phase_seconds", total - waited, endpoint=name, phase="read")
+        self.shell.debug("HTTP", request.method, name, response.status_code, f"{total:.2f}s",
+                         f"(connect {connect:.2f}s, wait {max(waited - connect, 0):.2f}s, read {total - waited:.2f}s)",
+                         sent, "bytes up,", received, "down" + (f", {len(retries)} retries" if retries else ""))
+        return response
+
+    @staticmethod
+    def __body_size(request):
+        body = request.body
+        if body is None: return 0
+        if isinstance(body, (bytes, str)): return len(body)
+        # a file or generator; trust the header if there is one
+        return int(request.headers.get("Content-Length") or 0)
+
+
+def install(session: requests.Session, adapter: InstrumentedAdapter = None) -> InstrumentedAdapter:
+    """ Puts an InstrumentedAdapter in front of everything `session` sends. Returns it. """
+    adapter = InstrumentedAdapter() if adapter is None else adapter
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return adapter
+
+def install_on_client(client, shell: Shell = None) -> None:
+    """ Installs the transport on an instagrapi Client's private (app API) and public (web) sessions. """
+    for name in ("private", "public"):
+        session = getattr(client, name, None)
+        if isinstance(session, requests.Session): install(session, InstrumentedAdapter(shell=shell))
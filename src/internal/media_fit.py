@@ -0,0 +1,71 @@
+"""fits media into instagram's accepted shapes before it is queued"""
+
+import math
+
+from PIL import Image
+
+from src.config import (
+    ASPECT_POLICY, ASPECT_PAD_COLOR, MEDIA_MIN_WIDTH,
+    IMAGE_ASPECT_MIN, IMAGE_ASPECT_MAX, VIDEO_ASPECT_MIN, VIDEO_ASPECT_MAX,
+    VIDEO_MIN_SECONDS, VIDEO_MAX_SECONDS
+)
+
+
+class MediaRejected(Exception):
+    """ The file can't be made postable. """
+
+
+def fitted_size(width: int, height: int, lo: float, hi: float, policy: str = ASPECT_POLICY) -> (int, int):
+    """
+    Size that `width`x`height` has to be padded or cropped to (depending on
+    `policy`) for its aspect ratio to fall within [`lo`, `hi`]. Returns the
+    same size if it already does; raises MediaRejected if it doesn't and the
+    policy is "reject".
+    """
+    ratio = width / height
+    if lo <= ratio <= hi: return width, height
+    if policy == "pad":
+        # too tall -> widen, too wide -> heighten
+        if ratio < lo: return math.ceil(height * lo), height
+        return width, math.ceil(width / hi)
+    if policy == "crop":
+        if ratio < lo: return width, math.floor(width / lo)
+        return math.floor(height * hi), height
+    raise MediaRejected(f"aspect ratio {ratio:.2f} outside {lo:.2f}-{hi:.2f}")
+
+
+def fit_image(image: Image.Image) -> Image.Image:
+    """ Pads or crops an RGB image (already turned upright by its exif orientation) into the allowed aspect ratios. Raises MediaRejected if it can't. """
+    width, height = fitted_size(image.width, image.height, IMAGE_ASPECT_MIN, IMAGE_ASPECT_MAX)
+    if width < MEDIA_MIN_WIDTH:
+        raise MediaRejected(f"too small ({image.width}x{image.height})")
+    if (width, height) == image.size: return image
+    if width >= image.width and height >= image.height:
+        padded = Image.new("RGB", (width, height), ASPECT_PAD_COLOR)
+        padded.paste(image, ((width - image.width)//2, (height - image.height)//2))
+        return padded
+    left, top = (image.width - width)//2, (image.height - height)//2
+    return image.crop((left, top, left + width, top + height))
+
+
+def video_filter(info: dict) -> str:
+    """
+    ffmpeg video filter that pads or crops a probed video into the allowed
+    aspect ratios, or None if it doesn't need one. Raises MediaRejected if
+    the video can't be fixed. It goes by the size the video is shown at, and
+    so applies to it after ffmpeg's autorotation.
+    """
+    if info is None: return None  # nothing to go on, let instagram decide
+    duration = info["duration"]
+    if duration is not None and not VIDEO_MIN_SECONDS <= duration <= VIDEO_MAX_SECONDS:
+        raise MediaRejected(f"duration {duration:.1f}s outside {VIDEO_MIN_SECONDS}-{VIDEO_MAX_SECONDS}s")
+    width, height = fitted_size(info["width"], info["height"], VIDEO_ASPECT_MIN, VIDEO_ASPECT_MAX)
+    if width < MEDIA_MIN_WIDTH:
+        raise MediaRejected(f"too small ({info['width']}x{info['height']})")
+    if (width, height) == (info["width"], info["height"]): return None
+    # libx264 wants even sizes
+    width, height = width + width % 2, height + height % 2
+    if width >= info["width"] and height >= info["height"]:
+        r, g, b = ASPECT_PAD_COLOR
+        return f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=0x{r:02x}{g:02x}{b:02x}"
+    return f"crop={min(width, info['width'])}:{min(height, info['height'])}"
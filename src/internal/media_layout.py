@@ -0,0 +1,66 @@
+"""where sorted and discarded media live: sharded folders, files named by id"""
+
+import os
+import re
+import secrets
+
+
+SORTED_ROOT = "media/sorted"
+DISCARD_ROOT = "media/discard"
+ID_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+def new_id() -> str:
+    """ A random 16 hex digit id. Picking one never needs to look at the disk, and its first four digits pick the shard. """
+    return secrets.token_hex(8)
+
+def file_id(path: str) -> str:
+    """ The id a file is named by (`<id>.jpg`, `<id>-<name>.png`), or None if it isn't named by one. """
+    name = os.path.basename(path)[:16]
+    return name if ID_PATTERN.fullmatch(name) else None
+
+def shard_path(root: str, id: str, filename: str) -> str:
+    """ `<root>/ab/cd/<filename>` for an id starting with `abcd`, so no folder ever holds more than a few hundred entries. """
+    return f"{root}/{id[:2]}/{id[2:4]}/{filename}"
+
+
+def sorted_path(fmt: str) -> str:
+    """ A fresh `media/sorted/<fmt>/ab/cd/<id>.<fmt>` path. """
+    id = new_id()
+    return shard_path(f"{SORTED_ROOT}/{fmt}", id, f"{id}.{fmt}")
+
+def discard_path(path: str, reason: str = None) -> str:
+    """
+    Where a file goes when it's discarded: `media/discard/[<reason>/]ab/cd/`,
+    under its own id if it's named by one, otherwise as `<id>-<its name>`
+    so it can still be recognized.
+    """
+    root = DISCARD_ROOT if reason is None else f"{DISCARD_ROOT}/{reason}"
+    id = file_id(path)
+    if id is not None: return shard_path(root, id, os.path.basename(path))
+    id = new_id()
+    return shard_path(root, id, f"{id}-{os.path.basename(path)}")
+
+
+def move(path: str, new_path: str) -> str:
+    """ Renames `path` to `new_path`, making its shard folders if they don't exist yet. Returns `new_path`. """
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.rename(path, new_path)
+    return new_path
+
+
+def walk(root: str):
+    """ Paths of the files in a sharded folder, including any left at its top by the old flat layout. """
+    for entry in os.scandir(root):
+        if entry.is_file():
+            yield entry.path
+        elif entry.is_dir() and len(entry.name) == 2:
+            for shard in os.scandir(entry.path):
+                if not shard.is_dir(): continue
+                for file in os.scandir(shard.path):
+                    if file.is_file(): yield file.path
+
+def flat_files(root: str) -> list:
+    """ Files at the top of `root`, where the old flat layout kept them. """
+    if not os.path.isdir(root): return []
+    return [entry.path for entry in os.scandir(root) if entry.is_file()]
@@ -0,0 +1,93 @@
+"""reads stream info out of video files"""
+
+import json
+import time
+import threading
+import subprocess
+
+from src.internal import stats
+from src.config import PROBE_LOG_PATH, VIDEO_MAX_DIMENSION
+
+from threadsafe_shell import get_shell
+shell = get_shell()
+
+# what instagram takes without complaint; anything else gets re-encoded
+COMPATIBLE_CONTAINERS = {"mp4", "mov"}
+COMPATIBLE_VIDEO_CODECS = {"h264"}
+COMPATIBLE_AUDIO_CODECS = {"aac"}
+COMPATIBLE_PIXEL_FORMATS = {"yuv420p", "yuvj420p"}
+
+__log_lock = threading.Lock()
+
+
+def probe(path: str) -> dict:
+    """
+    Runs ffprobe on a file. Returns a dict with `container`, `video_codec`,
+    `audio_codec`, `pix_fmt`, `width`, `height`, `rotation`, `duration` and
+    `bit_rate` (bits/s, of the whole file if the stream doesn't say), or None
+    if the file couldn't be probed. `width` and `height` are the size it is
+    shown at, so with its rotation applied.
+    """
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+            check=True, capture_output=True, text=True
+        ).stdout
+        data = json.loads(out)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        shell.debug("Probe: could not probe", path, "-", str(e))
+        return None
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), None)
+    audio = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), None)
+    if video is None: return None
+    fmt = data.get("format", {})
+    duration = fmt.get("duration", video.get("duration"))
+    bit_rate = video.get("bit_rate", fmt.get("bit_rate"))
+    rotation = __rotation(video)
+    width, height = int(video.get("width", 0)), int(video.get("height", 0))
+    # phones film sideways and say so in the metadata; players (and ffmpeg when re-encoding) turn it upright
+    if rotation in (90, 270): width, height = height, width
+    return {
+        # ffprobe lumps these together as "mov,mp4,m4a,3gp,3g2,mj2"
+        "container": fmt.get("format_name", "").split(",")[:2],
+        "video_codec": video.get("codec_name"),
+        "audio_codec": None if audio is None else audio.get("codec_name"),
+        "pix_fmt": video.get("pix_fmt"),
+        "width": width,
+        "height": height,
+        "rotation": rotation,
+        "duration": None if duration is None else float(duration),
+        "bit_rate": None if bit_rate is None else int(bit_rate),
+    }
+
+
+def __rotation(stream: dict) -> int:
+    """ Clockwise rotation a video stream is meant to be shown with, 0, 90, 180 or 270. """
+    # older ffmpeg puts it in a tag, newer ones only in the display matrix side data (counter-clockwise there)
+    rotate = stream.get("tags", {}).get("rotate")
+    if rotate is None:
+        rotate = next((-float(side["rotation"]) for side in stream.get("side_data_list", []) if "rotation" in side), 0)
+    try: return round(float(rotate) / 90) % 4 * 90
+    except (ValueError, TypeError): return 0
+
+
+def incompatibility(info: dict) -> str:
+    """ Why a probed video can't be uploaded as-is, or None if it can be stream-copied. """
+    if info is None: return "unprobeable"
+    if not COMPATIBLE_CONTAINERS.intersection(info["container"]): return "container " + ",".join(info["container"])
+    if info["video_codec"] not in COMPATIBLE_VIDEO_CODECS: return f"video codec {info['video_codec']}"
+    if info["audio_codec"] is not None and info["audio_codec"] not in COMPATIBLE_AUDIO_CODECS: return f"audio codec {info['audio_codec']}"
+    if info["pix_fmt"] not in COMPATIBLE_PIXEL_FORMATS: return f"pixel format {info['pix_fmt']}"
+    if max(info["width"], info["height"]) > VIDEO_MAX_DIMENSION: return f"resolution {info['width']}x{info['height']}"
+    if info["width"] % 2 or info["height"] % 2: return f"odd resolution {info['width']}x{info['height']}"
+    return None
+
+
+def record(path: str, info: dict, action: str, reason: str = None) -> None:
+    """ Counts which path a video took and appends its probe result to PROBE_LOG_PATH. """
+    stats.incr("video_convert_path", action=action)
+    if not PROBE_LOG_PATH: return
+    line = json.dumps({"time": int(time.time()), "path": path, "action": action, "reason": reason, "probe": info})
+    with __log_lock:
+        with open(PROBE_LOG_PATH, "a") as file:
+            file.write(line + '\n')
@@ -0,0 +1,124 @@
+"""decides when files in media/outbound are ready to be sorted, and remembers the ones that weren't sortable"""
+
+import os
+import time
+import shutil
+import threading
+
+from src.config import SORT_STABLE_SECONDS, SORT_REJECT_RETRY_SECONDS, SORT_MAX_REJECTS
+
+from threadsafe_shell import Shell, get_shell
+
+
+class OutboundGate:
+    """
+    Sits between the watcher and the conversion pool.
+
+    A file is only let through once it hasn't been written to for
+    `stable_seconds` (going by its mtime and ctime), so a file that is still
+    being copied in isn't sniffed and converted half-written. Files that
+    aren't ready yet are held back and offered again once they might be.
+
+    Files the sort couldn't use, and left where they were, are remembered by
+    (inode, size, mtime), so the next scans skip them without even sniffing
+    them. They get retried after an exponentially growing wait, in case it
+    was something passing; after `max_rejects` tries they are moved to
+    `quarantine`. A file that is changed or replaced is treated as new.
+    """
+
+    def __init__(self, stable_seconds: float = SORT_STABLE_SECONDS, retry_seconds: float = SORT_REJECT_RETRY_SECONDS,
+                 max_rejects: int = SORT_MAX_REJECTS, quarantine: str = "media/quarantine", shell: Shell = None):
+        self.stable_seconds = stable_seconds
+        self.retry_seconds = retry_seconds
+        self.max_rejects = max(max_rejects, 1)
+        self.quarantine = quarantine
+        self.shell = get_shell() if shell is None else shell
+        self.__lock = threading.Lock()
+        # path -> time.time() it could be ready
+        self.__held = {}
+        # path -> {"fingerprint", "rejects", "retry_at"}
+        self.__rejected = {}
+
+    @staticmethod
+    def fingerprint(st: os.stat_result) -> tuple:
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+    def ready(self, paths: list) -> list:
+        """ Which of `paths` (plus whatever was held back earlier) can be sorted now. """
+        now = time.time()
+        with self.__lock:
+            candidates = list(dict.fromkeys(list(paths) + list(self.__held)))
+            self.__held = {}
+            ready = []
+            for path in candidates:
+                try: st = os.stat(path)
+                except OSError:
+                    # gone (sorted, moved out, deleted)
+                    self.__rejected.pop(path, None)
+                    continue
+                rejected = self.__rejected.get(path)
+                if rejected is not None:
+                    if rejected["fingerprint"] != self.fingerprint(st):
+                        del self.__rejected[path]  # changed since, so worth a fresh look
+                    elif now < rejected["retry_at"]:
+                        self.__held[path] = rejected["retry_at"]
+                        continue
+                # ctime too, since copying tools can set the mtime to the original's
+                settled_at = max(st.st_mtime, st.st_ctime) + self.stable_seconds
+                if now < settled_at:
+                    self.__held[path] = settled_at
+                    continue
+                ready.append(path)
+        return ready
+
+    def next_check(self) -> float:
+        """ Seconds until a held back file could be ready, None if none are held back. """
+        with self.__lock:
+            if not self.__held: return None
+            return max(min(self.__held.values()) - time.time(), 0)
+
+
+    def rejected(self, path: str) -> None:
+        """ Records that `path` couldn't be sorted and was left in place. Quarantines it after too many tries. """
+        try: st = os.stat(path)
+        except OSError: return
+        with self.__lock:
+            entry = self.__rejected.get(path)
+            if entry is None or entry["fingerprint"] != self.fingerprint(st):
+                entry = self.__rejected[path] = {"fingerprint": self.fingerprint(st), "rejects": 0}
+            entry["rejects"] += 1
+            if entry["rejects"] < self.max_rejects:
+                wait = self.retry_seconds * 2**(entry["rejects"] - 1)
+                entry["retry_at"] = time.time() + wait
+                self.shell.debug("Gate: skipping", path, "for", int(wait), "seconds")
+                return
+            del self.__rejected[path]
+        moved = self.__quarantine(path)
+        if moved: self.shell.warn("Sort: Gave up on", path, "after", self.max_rejects, "tries - moved to", moved)
+
+    def accepted(self, path: str) -> None:
+        """ Records that `path` was dealt with, so nothing about it needs remembering. """
+        with self.__lock:
+            self.__rejected.pop(path, None)
+
+    def __quarantine(self, path):
+        os.makedirs(self.quarantine, exist_ok=True)
+        name, ext = os.path.splitext(os.path.basename(path))
+        new_path = f"{self.quarantine}/{name}{ext}"
+        i = 1
+        while os.path.exists(new_path):
+            new_path = f"{self.quarantine}/{name}-{i}{ext}"
+            i += 1
+        try:
+            shutil.move(path, new_path)
+        except OSError as e:
+            self.shell.warn("Sort: Could not quarantine", path, "-", str(e))
+            return None
+        return new_path
+
+
+    def __len__(self) -> int:
+        """ Files currently held back or remembered as rejected. """
+        with self.__lock:
+            return len(self.__held) + len(self.__rejected)
@@ -0,0 +1,81 @@
+"""watches media/outbound for new files"""
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # not on linux, or not installed
+    INotify = None
+
+from src.config import SORT_SLEEP_SECONDS, SORT_WATCH_MODE
+
+from threadsafe_shell import Shell, get_shell
+
+
+class OutboundWatcher:
+    """
+    Hands out paths of files dropped into a folder.
+
+    In `"inotify"` mode the kernel tells us when a file has been closed after
+    writing or moved into the folder, so only those files are handed out and
+    nothing touches the disk in between. In `"poll"` mode (or when inotify is
+    not available) the folder is re-listed every `SORT_SLEEP_SECONDS`.
+    """
+
+    def __init__(self, folder: str = "media/outbound", mode: str = SORT_WATCH_MODE, subfolders: list = (), shell: Shell = None):
+        self.folder = folder
+        # subfolders (e.g. per-account drop folders) are watched too, but not anything below them
+        self.folders = [folder] + [folder+"/"+sub for sub in subfolders]
+        self.shell = get_shell() if shell is None else shell
+        self.__inotify = None
+        self.__watches = {}
+        if mode == "inotify":
+            if INotify is None:
+                self.shell.warn("Watch: inotify_simple not available, falling back to polling.")
+            else:
+                try:
+                    self.__inotify = INotify()
+                    # the watch goes in before the first listing, so nothing slips between the two
+                    for watched in self.folders:
+                        self.__watches[self.__inotify.add_watch(watched, flags.CLOSE_WRITE | flags.MOVED_TO)] = watched
+                except OSError as e:
+                    self.shell.warn("Watch: could not set up inotify, falling back to polling:", str(e))
+                    self.__inotify = None
+        elif mode != "poll":
+            self.shell.warn("Watch: unknown SORT_WATCH_MODE", mode, "- falling back to polling.")
+        self.mode = "poll" if self.__inotify is None else "inotify"
+        self.shell.debug("Watch: watching", folder, "with", self.mode)
+
+
+    def __list(self) -> list:
+        return [entry.path for watched in self.folders for entry in os.scandir(watched) if entry.is_file()]
+
+    def existing(self) -> list:
+        """ Returns every file already in the folder. Call once at startup to drain it. """
+        return self.__list()
+
+    def wait_for_new(self, timeout: float = None) -> list:
+        """ Blocks until there is something new, or `timeout` seconds pass, then returns the paths to process (maybe none). """
+        if self.__inotify is None:
+            time.sleep(SORT_SLEEP_SECONDS if timeout is None else min(timeout, SORT_SLEEP_SECONDS))
+            return self.__list()
+        paths = []
+        while not paths:
+            # read_delay lets a burst of events pile up so they come back as one batch
+            events = self.__inotify.read(timeout=None if timeout is None else int(timeout*1000)+1, read_delay=100)
+            if not events and timeout is not None: return []
+            for event in events:
+                # the kernel dropped events, so we can't know what came in - list everything
+                if event.mask & flags.Q_OVERFLOW: return self.__list()
+                if event.mask & flags.ISDIR or not event.name: continue
+                path = self.__watches[event.wd]+"/"+event.name
+                if path not in paths: paths.append(path)
+        # the file may have been moved back out between the event and now
+        return [path for path in paths if os.path.isfile(path)]
+
+
+    def close(self) -> None:
+        if self.__inotify is not None:
+            self.__inotify.close()
+            self.__inotify = None
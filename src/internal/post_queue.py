@@ -4,12 +4,15 @@
 
 import os
 import time
+import bisect
 import datetime
 import random
+import threading
 
-from instagrapi import Client
-from instagrapi.exceptions import UnknownError
-
+from src.internal import stats
+from src.internal import media_layout
+from src.internal.queue_journal import QueueJournal
+from src.internal.rate_governor import RateGovernor, is_rate_limit
 from src.config import (
     POST_DELAY_MIN_SECONDS, POST_DELAY_MAX_SECONDS
 )
@@ -17,31 +20,170 @@ from src.config import (
 from threadsafe_shell import Shell, get_shell
 
 class PostQueue:
-    def __init__(self, client: Client, shell: Shell = None):
-        self.__queue = list()
+    """
+    Queue of sorted files waiting to be posted, and the cooldown between posts.
+
+    Items live in a list, with a dict mapping each path to its index in that
+    list. Removal swaps the last item into the hole, so adding, membership,
+    picking a random item and removing it are all O(1).
+
+    Every item also gets an increasing sequence number when it is added, which
+    is what `page` lists by: a page starts after the last sequence number of
+    the one before, so paging stays cheap and consistent while items come and go.
+    """
+
+    # listener events that don't take an item out of the queue; any other event is the reason one was removed
+    NON_REMOVAL_EVENTS = ("add", "lineup", "pause", "resume")
+
+    # `client` is an instagrapi Client (None to only queue files); not imported here so sorting never loads instagrapi
+    def __init__(self, client, shell: Shell = None, journal: QueueJournal = None, governor: RateGovernor = None):
+        self.__items = list()
+        self.__index = dict()
+        # sequence numbers, for paging: ascending list (with removed ones left in until compacted) and both lookups
+        self.__order = list()
+        self.__seq = dict()
+        self.__by_seq = dict()
+        self.__next_seq = 1
+        self.paused = False
+        # items picked ahead of time, in posting order; get_next_filename hands out the first
+        self.__upcoming = list()
+        self.__lock = threading.RLock()
         self.__cooldown_expires = int(time.time())
         self.client = client
         self.shell = get_shell() if shell is None else shell
+        self.journal = journal
+        self.governor = governor
+        self.__listeners = list()
+        # time.monotonic() of the last upload call, for measuring how long a post took to get going
+        self.upload_started = None
+        # items that were in an album that failed, to be posted on their own so a bad one can be told apart
+        self.__solo = set()
+        # name and size of the file an item was sorted from: the name for finding its caption, the size (when it
+        # was optimized) to tell how much upload time that saved
+        self.__sources = dict()
 
 
     class AlreadyInQueueException(Exception): pass
 
-    def add(self, path):
-        if path in self.__queue:
+    def add_listener(self, func) -> None:
+        """
+        Calls `func(event, path)` whenever an item is added, removed or lined up, or posting is paused or resumed.
+        `event` is one of `NON_REMOVAL_EVENTS` (`path` is None for "pause" and "resume"), or else the removal reason.
+        """
+        self.__listeners.append(func)
+
+    def __notify(self, event, path):
+        for func in self.__listeners:
+            func(event, path)
+
+
+    def add(self, path, source_bytes: int = None, source_name: str = None):
+        with self.__lock:
+            self.__append(path)
+            if source_bytes is not None or source_name is not None: self.__sources[path] = (source_name, source_bytes)
+        if self.journal is not None: self.journal.add(path, source_bytes, source_name)
+        self.__notify("add", path)
+
+    def __append(self, path):
+        if path in self.__index:
             raise self.__class__.AlreadyInQueueException(path + " already in queue!")
-        self.__queue.append(path)
+        self.__index[path] = len(self.__items)
+        self.__items.append(path)
+        seq = self.__seq[path] = self.__next_seq
+        self.__by_seq[seq] = path
+        self.__order.append(seq)
+        self.__next_seq += 1
+
+    def remove(self, path, reason: str = "removed", detail: str = None) -> bool:
+        """ Removes `path` from the queue, journaling `reason`. Returns False if it wasn't queued. """
+        with self.__lock:
+            i = self.__index.pop(path, None)
+            if i is None: return False
+            last = self.__items.pop()
+            if i < len(self.__items):
+                # fill the hole with the last item
+                self.__items[i] = last
+                self.__index[last] = i
+            del self.__by_seq[self.__seq.pop(path)]
+            # drop removed sequence numbers once they're most of the list, so paging doesn't wade through them
+            if len(self.__order) > 1024 and len(self.__order) > 2*len(self.__by_seq):
+                self.__order = [seq for seq in self.__order if seq in self.__by_seq]
+            if path in self.__upcoming: self.__set_upcoming([p for p in self.__upcoming if p != path])
+            self.__solo.discard(path)
+            self.__sources.pop(path, None)
+        if self.journal is not None: self.journal.remove(path, reason, detail)
+        self.__notify(reason, path)
+        return True
+
+    def paths(self) -> list:
+        """ Copy of the queued paths, in no particular order. """
+        with self.__lock:
+            return list(self.__items)
+
+    def page(self, cursor: int = None, limit: int = 50) -> (list, int):
+        """
+        Up to `limit` items added after the one with sequence number `cursor`
+        (from the start if None), oldest first, as dicts of path, seq and
+        position in the lineup (None if not lined up). Returns them and the
+        cursor for the next page, None if this was the last.
+        """
+        with self.__lock:
+            items = []
+            i = bisect.bisect_right(self.__order, cursor or 0)
+            while i < len(self.__order) and len(items) < limit:
+                path = self.__by_seq.get(self.__order[i])
+                if path is not None:
+                    lined_up = self.__upcoming.index(path) if path in self.__upcoming else None
+                    items.append({"path": path, "seq": self.__order[i], "upcoming": lined_up})
+                i += 1
+            # (if everything after this page was removed, the next one just comes back empty)
+            return items, (items[-1]["seq"] if items and i < len(self.__order) else None)
+
+    def source_name(self, path) -> str:
+        """ Name the file of a queued item had in `media/outbound`, None if it wasn't recorded. """
+        return self.__sources.get(path, (None, None))[0]
+
+    def seq(self, path) -> int:
+        """ Sequence number of a queued item, None if it isn't queued. """
+        return self.__seq.get(path)
+
+
+    def restore(self) -> int:
+        """ Refills the queue and cooldown from the journal. Returns how many items were restored. """
+        if self.journal is None: return 0
+        with self.__lock:
+            for path in self.journal.items():
+                if path not in self.__index: self.__append(path)
+            self.__sources.update(self.journal.sources())
+            selected = self.journal.get_meta("selected")
+            if selected in self.__index: self.__upcoming = [selected]
+        expires = self.journal.get_meta("cooldown_expires")
+        if expires is not None: self.__cooldown_expires = int(expires)
+        self.paused = self.journal.get_meta("paused") == "1"
+        return len(self)
     
 
-    def generate_new_cooldown(self, posted=True, nothing_to_post=False) -> None:
-        if nothing_to_post:
-            self.__cooldown_expires = int(time.time()) + 30
+    def __set_cooldown(self, seconds):
+        self.__cooldown_expires = int(time.time()) + seconds
+        if self.journal is not None: self.journal.set_meta("cooldown_expires", self.__cooldown_expires)
+
+    def generate_new_cooldown(self, posted=True, nothing_to_post=False, backoff=None) -> None:
+        if backoff is not None:
+            self.__set_cooldown(int(backoff))
+            self.shell.log("Rate limited. Waiting", self.shell.highlight(int(backoff)), "seconds before posting again.")
+        elif nothing_to_post:
+            self.__set_cooldown(30)
             self.shell.log("Nothing to post. Waiting", self.shell.highlight(30), "seconds for next scan.")
         elif not posted:
-            self.__cooldown_expires = int(time.time()) + 10
+            self.__set_cooldown(10)
             self.shell.log("Last post not successfully posted. Waiting", self.shell.highlight(10), "seconds for API cooldown.")
         else:
             cool = random.randint(POST_DELAY_MIN_SECONDS, POST_DELAY_MAX_SECONDS)
-            self.__cooldown_expires = int(time.time()) + cool
+            if self.governor is not None:
+                # the governor sets the pace; the configured spread is kept as jitter on top of it
+                pace = self.governor.delay("upload")
+                cool = int(max(pace, POST_DELAY_MIN_SECONDS)) + cool - POST_DELAY_MIN_SECONDS
+            self.__set_cooldown(cool)
             self.shell.log("New post cooldown", self.shell.highlight(cool), "seconds.")
 
 
@@ -59,54 +201,136 @@ class PostQueue:
     
 
     def get_next_filename(self):
-        return random.choice(self.__queue)
+        """ Picks the next file to post, at random. Stays the same until it's posted or removed. """
+        with self.__lock:
+            if not self.__upcoming: self.reserve()
+            return self.__upcoming[0] if self.__upcoming else None
+
+    def reserve(self):
+        """
+        Picks a random item that isn't already lined up and lines it up after
+        the others, so it can be prepared ahead of time. Returns None if there is none left.
+        """
+        with self.__lock:
+            if len(self.__upcoming) >= len(self.__items): return None
+            # only a handful are ever lined up, so a few random tries almost always land
+            for _ in range(8):
+                path = random.choice(self.__items)
+                if path not in self.__upcoming: break
+            else:
+                path = random.choice([p for p in self.__items if p not in self.__upcoming])
+            self.__set_upcoming(self.__upcoming + [path])
+            return path
+
+    def line_up(self, path, position: int = None) -> bool:
+        """
+        Moves a queued item to `position` in the lineup (0 posts it next, None
+        puts it after the ones already lined up). Returns False if it isn't queued.
+        """
+        with self.__lock:
+            if path not in self.__index: return False
+            upcoming = [p for p in self.__upcoming if p != path]
+            upcoming.insert(len(upcoming) if position is None else max(position, 0), path)
+            self.__set_upcoming(upcoming)
+        self.__notify("lineup", path)
+        return True
+
+    def pin(self, path) -> bool:
+        """ Makes a queued item the next one posted. Returns False if it isn't queued. """
+        return self.line_up(path, 0)
+
+    def pause(self) -> None:
+        """ Stops posting (sorting carries on) until `resume`. Survives restarts. """
+        self.__set_paused(True)
+
+    def resume(self) -> None:
+        self.__set_paused(False)
+
+    def __set_paused(self, paused):
+        if self.paused == paused: return
+        self.paused = paused
+        if self.journal is not None: self.journal.set_meta("paused", int(paused))
+        self.__notify("pause" if paused else "resume", None)
+
+    def solo(self, path) -> bool:
+        """ Whether a queued item has to be posted on its own, because an album it was in failed. """
+        return path in self.__solo
+
+    def upcoming(self) -> list:
+        """ Copy of the lined up items, next to be posted first. """
+        with self.__lock:
+            return list(self.__upcoming)
+
+    def unreserved(self) -> int:
+        """ Number of items not lined up yet. """
+        with self.__lock:
+            return len(self.__items) - len(self.__upcoming)
+
+    def __set_upcoming(self, paths):
+        old_head = self.__upcoming[0] if self.__upcoming else None
+        self.__upcoming = paths
+        new_head = paths[0] if paths else None
+        if self.journal is not None and new_head != old_head: self.journal.set_meta("selected", new_head)
 
 
-    def post(self, *args, **kwargs) -> (bool, object):
-        if len(self.__queue) == 0: return True, "nothing to post"
-        path = self.__queue.pop(0)
+    def post(self, *args, path: str = None, **kwargs) -> (bool, object):
+        """
+        Uploads the next file in the queue with the caption and options in
+        `kwargs`. Callers that prepared a particular file pass its `path`, so
+        that file is the one posted whatever has been lined up since.
+        """
+        if path is None:
+            path = self.get_next_filename()
+            if path is None: return True, "nothing to post"
+        elif path not in self: return True, "no longer queued"
         (folder, filename, filefmt) = self.__class__.parse_path(path)
         # try upload
         self.shell.log("UPL  Posting", path)
         self.shell.debug("UPL  Attempting to upload", path)
         did_error = False
+        sizes = self.__sizes([path])
+        self.upload_started = time.monotonic()
+        if self.governor is not None: self.governor.take("upload")
         try:
             if filefmt == "jpg": media = self.client.photo_upload(path, *args, **kwargs)
             elif filefmt == "mp4": media = self.client.video_upload(path, *args, **kwargs)
-            else: return True, "invalid mime type"
+            else:
+                self.remove(path, "discarded", "invalid mime type")
+                return True, "invalid mime type"
+            stats.observe("upload_seconds", time.monotonic() - self.upload_started, type=filefmt)
+            stats.incr("uploads", type=filefmt, outcome="ok")
+            self.__report_upload([path], sizes, time.monotonic() - self.upload_started)
             data = media.dict()
             data["taken_at"] = data["taken_at"] - datetime.timedelta(hours=4)  # apply timezone info, the messy and bad way but idc
             self.shell.success("UPL  Posted", self.shell.highlight(filename+'.'+filefmt), "at", data["taken_at"].strftime("%I:%M on %b %-d"))
-            try:
-                self.shell.debug("Sleeping 3 seconds to like post, to avoid ratelimits")
-                time.sleep(3) # ratelimit mitigation
-                self.client.media_like(data["id"])
-                self.shell.log("UPL  Successfully liked uploaded post.")
-            except Exception as e:
-                self.shell.warn("UPL  Couldn't like post, failed with error:", str(e))
+            if self.governor is not None: self.governor.success("upload")
+            self.__like(data["id"])
             self.generate_new_cooldown()
         except Exception as e:
             did_error = True
             data = {"exception": e}
-            self.generate_new_cooldown(posted=False)
+            stats.incr("uploads", type=filefmt, outcome=type(e).__name__)
+            limited = is_rate_limit(e)
+            if limited and self.governor is not None:
+                self.generate_new_cooldown(backoff=self.governor.blocked("upload", e))
+            else: self.generate_new_cooldown(posted=False)
             if "Uploaded image isn't in an allowed aspect ratio" in str(e):
                 self.shell.warn("UPL  Image not in correct aspect ratio, skipping!")
-            elif "Please wait a few minutes before you try again" in str(e):
+            elif limited:
                 self.shell.error("Response 403 received!")
+                # nothing wrong with the file, keep it queued for another go, after the others lined up
+                self.__requeue([path])
+                data["filename"] = filename
+                data["media_type"] = filefmt
+                return did_error, data
             else:
                 self.shell.error("UPL  Error occurred uploading post!")
                 self.shell.error("UPL    format:", filefmt)
                 self.shell.error("UPL    filename:", filename)
                 self.shell.error("UPL    exception:", str(e))
-            # move to error discard
-            os.rename(path, "media/discard/error/"+filename+"."+filefmt)
-            if filefmt == "mp4": os.remove(path+".jpg") # delete autogenerated thumbnail
-            self.shell.debug("UPL  Moved to error discard folder.")
+            self.discard(path, str(e))
         else:
-            # move to normal discard
-            os.rename(path, "media/discard/"+filename+"."+filefmt)
-            if filefmt == "mp4": os.remove(path+".jpg") # delete autogenerated thumbnail
-            self.shell.debug("UPL  Moved to discard folder.")   
+            self.__posted(path)
         # return data
         data["filename"] = filename
         data["media_type"] = filefmt
@@ -114,6 +338,126 @@ class PostQueue:
         return did_error, data
     
     
+    def post_album(self, paths: list, *args, **kwargs) -> (bool, object):
+        """
+        Posts several queued files (the first one lined up next) as one
+        carousel, with the caption and options in `kwargs`. If it fails for
+        anything but a rate limit nothing is discarded, since there's no
+        telling which file was the problem: they are all marked to be posted
+        on their own instead, where `post` sorts out the bad one.
+        """
+        kwargs.pop("thumbnail", None)  # one per video, instagrapi makes them itself for albums
+        self.shell.log("UPL  Posting album of", self.shell.highlight(len(paths)), "files:", ", ".join(paths))
+        sizes = self.__sizes(paths)
+        self.upload_started = time.monotonic()
+        if self.governor is not None: self.governor.take("upload")
+        try:
+            media = self.client.album_upload(paths, *args, **kwargs)
+        except Exception as e:
+            stats.incr("uploads", type="album", outcome=type(e).__name__)
+            if is_rate_limit(e):
+                if self.governor is not None: self.generate_new_cooldown(backoff=self.governor.blocked("upload", e))
+                else: self.generate_new_cooldown(posted=False)
+                self.shell.error("Response 403 received!")
+                self.__requeue(paths)
+            else:
+                self.generate_new_cooldown(posted=False)
+                self.shell.error("UPL  Error occurred uploading album:", str(e))
+                with self.__lock:
+                    self.__solo.update(path for path in paths if path in self.__index)
+                self.shell.warn("UPL  Posting its", len(paths), "files one at a time instead.")
+            return True, {"exception": e, "paths": paths}
+        stats.observe("upload_seconds", time.monotonic() - self.upload_started, type="album")
+        stats.incr("uploads", type="album", outcome="ok")
+        self.__report_upload(paths, sizes, time.monotonic() - self.upload_started)
+        data = media.dict()
+        data["taken_at"] = data["taken_at"] - datetime.timedelta(hours=4)  # same as post
+        self.shell.success("UPL  Posted album of", self.shell.highlight(len(paths)), "files at", data["taken_at"].strftime("%I:%M on %b %-d"))
+        if self.governor is not None: self.governor.success("upload")
+        self.__like(data["id"])
+        self.generate_new_cooldown()
+        for path in paths: self.__posted(path)
+        data["paths"] = paths
+        self.shell.debug("UPL  Done album upload cycle.")
+        return False, data
+
+    @staticmethod
+    def __sizes(paths):
+        sizes = []
+        for path in paths:
+            try: sizes.append(os.path.getsize(path))
+            except OSError: sizes.append(0)
+        return sizes
+
+    def __report_upload(self, paths, sizes, took):
+        sent = sum(sizes)
+        stats.incr("upload_bytes", sent)
+        with self.__lock:
+            known = [self.__sources.get(path, (None, None))[1] for path in paths]
+        if all(size is None for size in known): return
+        source = sum(size if known_size is None else known_size for size, known_size in zip(sizes, known))
+        if not sent or not took: return
+        # the uplink is what takes the time, so the originals would have taken about as much longer as they are bigger
+        unoptimized = took * source / sent
+        stats.incr("upload_seconds_saved", max(unoptimized - took, 0))
+        self.shell.log("UPL  Sent", f"{sent/1e6:.2f} MB in {took:.1f}s - the", f"{source/1e6:.2f} MB", "unoptimized",
+                       "file" if len(paths) == 1 else "files", "would have taken about", f"{unoptimized:.1f}s",
+                       "(" + self.shell.highlight(f"{took - unoptimized:+.1f}s") + ")")
+
+    def __like(self, media_id):
+        try:
+            if self.governor is not None:
+                self.governor.acquire("like")
+            else:
+                self.shell.debug("Sleeping 3 seconds to like post, to avoid ratelimits")
+                time.sleep(3) # ratelimit mitigation
+            self.client.media_like(media_id)
+            if self.governor is not None: self.governor.success("like")
+            self.shell.log("UPL  Successfully liked uploaded post.")
+        except Exception as e:
+            if self.governor is not None and is_rate_limit(e): self.governor.blocked("like", e)
+            self.shell.warn("UPL  Couldn't like post, failed with error:", str(e))
+
+    def __requeue(self, paths):
+        # rate limited: keep them for another go, after the others lined up
+        with self.__lock:
+            self.__set_upcoming([p for p in self.__upcoming if p not in paths] + [p for p in paths if p in self.__index])
+        for path in paths:
+            attempts = self.journal.attempt(path) if self.journal is not None else "?"
+            self.shell.debug("UPL  Left", path, "in queue, attempt", attempts)
+
+    def __posted(self, path):
+        # move to normal discard
+        (folder, filename, filefmt) = self.__class__.parse_path(path)
+        moved = self.__move_out(path, media_layout.discard_path(path))
+        self.__remove_thumbnail(path, filefmt)
+        self.remove(path, "posted")
+        self.shell.debug("UPL  Moved", filename+"."+filefmt, "to", moved)
+
+
+    def discard(self, path, detail: str = None, reason: str = "error") -> None:
+        """ Moves a queued file that won't be posted to its shard of `media/discard/<reason>/`, and drops it from the queue. """
+        (folder, filename, filefmt) = self.__class__.parse_path(path)
+        moved = self.__move_out(path, media_layout.discard_path(path, reason))
+        self.__remove_thumbnail(path, filefmt)
+        self.remove(path, "discarded" if reason == "error" else reason, detail)
+        self.shell.debug("UPL  Moved", filename+"."+filefmt, "to", moved)
+
+    def __move_out(self, path, new_path):
+        try: return media_layout.move(path, new_path)
+        except FileNotFoundError:
+            # already moved away, e.g. removed from the panel while it was uploading
+            self.shell.debug("UPL ", path, "was already gone")
+            return None
+
+    @staticmethod
+    def __remove_thumbnail(path, filefmt):
+        # instagrapi drops an autogenerated thumbnail next to uploaded videos
+        if filefmt != "mp4": return
+        try: os.remove(path+".jpg")
+        except FileNotFoundError: pass
+
+
     def get_cooldown(self) -> int:
         return max(self.__cooldown_expires - int(time.time()), 0)
     
@@ -122,10 +466,14 @@ class PostQueue:
 
 
     def __len__(self) -> int:
-        return len(self.__queue)
+        return len(self.__items)
+
+    def __contains__(self, path) -> bool:
+        return path in self.__index
 
     def __repr__(self) -> str:
-        return f"<PostQueue length={self.length()} {str(self.__queue)}>"
+        # the queue can be huge, so only what's lined up
+        return f"<PostQueue length={len(self)} upcoming={self.upcoming()}{' paused' if self.paused else ''}>"
     
     def __str__(self) -> str:
-        return f"<PostQueue length={self.length()} {str(self.__queue)}>"
+        return repr(self)
@@ -0,0 +1,170 @@
+"""on-disk journal backing the post queue"""
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class QueueJournal:
+    """
+    SQLite (WAL mode) record of what is queued, what happened to everything
+    that left the queue, and the post cooldown, so a restart can pick up
+    exactly where the last run stopped.
+
+    Also remembers the mtime of each folder the queue was filled from, and of
+    the shard folders below it, as of the last time everything in them was
+    known to it. A tree where none of those changed since was not touched by
+    anyone else, so it doesn't have to be listed again on startup.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL can only lose the last few commits on power loss, never corrupt
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+                path     TEXT NOT NULL UNIQUE,
+                added    REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                source_bytes INTEGER,
+                source_name  TEXT
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                path     TEXT NOT NULL,
+                event    TEXT NOT NULL,
+                time     REAL NOT NULL,
+                attempts INTEGER NOT NULL,
+                detail   TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        # journals from before sources were kept
+        columns = [row[1] for row in self.__db.execute("PRAGMA table_info(items)")]
+        if "source_bytes" not in columns: self.__db.execute("ALTER TABLE items ADD COLUMN source_bytes INTEGER")
+        if "source_name" not in columns: self.__db.execute("ALTER TABLE items ADD COLUMN source_name TEXT")
+
+
+    def __execute(self, sql, *params):
+        with self.__lock:
+            return self.__db.execute(sql, params).fetchall()
+
+    def __touch_folder(self, path):
+        folders = [os.path.dirname(path)]
+        while os.path.dirname(folders[-1]): folders.append(os.path.dirname(folders[-1]))
+        # a new shard folder changes the one above it too, so everything up to the top of the scanned tree gets updated
+        tracked = [i for i in range(1, len(folders)) if self.get_meta("mtime:"+folders[i]) is not None]
+        for folder in folders[:(tracked[-1] if tracked else 0) + 1]:
+            mtime = self.__settled_mtime(folder)
+            # left as it was, so the next start sees the change and lists the tree
+            if mtime is None: return
+            self.set_meta("mtime:"+folder, mtime)
+
+    def __settled_mtime(self, folder):
+        """
+        The mtime of `folder` if everything in it is accounted for (files
+        journaled, folders tracked), otherwise None. Conversions place files
+        in parallel, so the mtime may already include a file whose `add`
+        hasn't happened yet; recording it then would hide that file from the
+        next start if it crashed in between.
+        """
+        try:
+            # stat first: anything placed after it changes the mtime again
+            mtime = os.stat(folder).st_mtime_ns
+            entries = list(os.scandir(folder))
+        except OSError: return None
+        files = [entry.path for entry in entries if not entry.is_dir()]
+        folders = [entry.path for entry in entries if entry.is_dir()]
+        if files:
+            journaled = {row[0] for row in self.__execute("SELECT path FROM items WHERE path > ? AND path < ?", folder+"/", folder+"0")}
+            if any(file not in journaled for file in files): return None
+        for i in range(0, len(folders), 500):
+            chunk = folders[i:i+500]
+            known = self.__execute(f"SELECT COUNT(*) FROM meta WHERE key IN ({','.join('?'*len(chunk))})", *("mtime:"+f for f in chunk))[0][0]
+            if known < len(chunk): return None
+        return mtime
+
+    def add(self, path: str, source_bytes: int = None, source_name: str = None) -> None:
+        self.__execute("INSERT OR IGNORE INTO items (path, added, source_bytes, source_name) VALUES (?, ?, ?, ?)",
+                       path, time.time(), source_bytes, source_name)
+        self.__touch_folder(path)
+
+    def attempt(self, path: str) -> int:
+        """ Counts a failed attempt at posting `path` that left it queued. Returns the new count. """
+        self.__execute("UPDATE items SET attempts = attempts + 1 WHERE path = ?", path)
+        rows = self.__execute("SELECT attempts FROM items WHERE path = ?", path)
+        return rows[0][0] if rows else 0
+
+    def remove(self, path: str, event: str, detail: str = None) -> None:
+        """ Takes `path` out of the queue, recording why (`"posted"`, `"discarded"`, `"missing"`...). """
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                rows = self.__db.execute("SELECT attempts FROM items WHERE path = ?", (path,)).fetchall()
+                self.__db.execute("DELETE FROM items WHERE path = ?", (path,))
+                self.__db.execute("INSERT INTO history (path, event, time, attempts, detail) VALUES (?, ?, ?, ?, ?)",
+                                  (path, event, time.time(), rows[0][0] if rows else 0, detail))
+        self.__touch_folder(path)
+
+
+    def items(self) -> list:
+        """ Queued paths, in the order they were added. """
+        return [row[0] for row in self.__execute("SELECT path FROM items ORDER BY seq")]
+
+    def rename(self, path: str, new_path: str, source_name: str = None) -> bool:
+        """ Points a queued item at where its file was moved, recording `source_name` if it has none. Returns False if it isn't queued. """
+        with self.__lock:
+            changed = self.__db.execute("UPDATE items SET path = ?, source_name = COALESCE(source_name, ?) WHERE path = ?",
+                                        (new_path, source_name, path)).rowcount
+            self.__db.execute("UPDATE meta SET value = ? WHERE key = 'selected' AND value = ?", (new_path, path))
+        return bool(changed)
+
+    def sources(self) -> dict:
+        """ (name, size) of the file each queued path was sorted from, for the ones where either was recorded. """
+        rows = self.__execute("SELECT path, source_name, source_bytes FROM items WHERE source_name IS NOT NULL OR source_bytes IS NOT NULL")
+        return {path: (name, size) for path, name, size in rows}
+
+    def attempts(self, path: str) -> int:
+        rows = self.__execute("SELECT attempts FROM items WHERE path = ?", path)
+        return rows[0][0] if rows else 0
+
+
+    def get_meta(self, key: str, default=None):
+        rows = self.__execute("SELECT value FROM meta WHERE key = ?", key)
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key: str, value) -> None:
+        self.__execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", key, None if value is None else str(value))
+
+    def folder_changed(self, folder: str) -> bool:
+        """ Whether `folder`, or any folder below it, was modified since the journal last touched it. """
+        # every key under `folder/`, '0' being the character after '/'
+        rows = self.__execute("SELECT key, value FROM meta WHERE key = ? OR (key > ? AND key < ?)",
+                              "mtime:"+folder, "mtime:"+folder+"/", "mtime:"+folder+"0")
+        if not any(key == "mtime:"+folder for key, value in rows): return True
+        for key, value in rows:
+            try: mtime = os.stat(key[len("mtime:"):]).st_mtime_ns
+            except OSError: return True
+            if value != str(mtime): return True
+        return False
+
+    def mark_folder_scanned(self, folder: str) -> None:
+        """ Records the mtimes of `folder` and every folder below it, as just listed. """
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.execute("DELETE FROM meta WHERE key > ? AND key < ?", ("mtime:"+folder+"/", "mtime:"+folder+"0"))
+                for root, dirs, files in os.walk(folder):
+                    self.__db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("mtime:"+root, str(os.stat(root).st_mtime_ns)))
+
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__db.close()
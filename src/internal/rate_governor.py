@@ -0,0 +1,130 @@
+"""paces api actions to stay under instagram's rate limits"""
+
+import os
+import json
+import time
+import random
+import threading
+
+from src.config import (
+    RATE_LIMITS, RATE_BACKOFF_BASE_SECONDS, RATE_BACKOFF_MAX_SECONDS, RATE_RECOVERY, RATE_MIN_FACTOR
+)
+
+from threadsafe_shell import Shell, get_shell
+
+
+def is_rate_limit(e: Exception) -> bool:
+    """ Whether an instagrapi exception means we are going too fast. """
+    # imported here so the governor itself doesn't need instagrapi loaded
+    from instagrapi.exceptions import PleaseWaitFewMinutes, FeedbackRequired
+    return isinstance(e, (PleaseWaitFewMinutes, FeedbackRequired)) \
+        or "Please wait a few minutes before you try again" in str(e)
+
+
+class RateGovernor:
+    """
+    A token bucket per action type ("upload", "like", "login"), refilled at the
+    rate from RATE_LIMITS scaled by a per-action factor.
+
+    When instagram pushes back, the action is blocked for an exponentially
+    growing, jittered backoff and its factor is halved. Every success after
+    that nudges the factor back up by RATE_RECOVERY, so the pace creeps back
+    toward the configured rate instead of jumping straight back to it.
+
+    The state is saved as JSON after every change, so a restart doesn't forget a block.
+    """
+
+    def __init__(self, state_path: str = None, limits: dict = RATE_LIMITS, shell: Shell = None):
+        self.state_path = state_path
+        self.limits = limits
+        self.shell = get_shell() if shell is None else shell
+        self.__lock = threading.Lock()
+        self.__state = {}
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r") as file:
+                    self.__state = json.load(file)
+            except (OSError, ValueError) as e:
+                self.shell.warn("Rate: could not read saved state, starting fresh:", str(e))
+        for action in limits:
+            self.__state.setdefault(action, {})
+            self.__state[action].setdefault("tokens", float(limits[action][1]))
+            self.__state[action].setdefault("updated", time.time())
+            self.__state[action].setdefault("factor", 1.0)
+            self.__state[action].setdefault("level", 0)
+            self.__state[action].setdefault("blocked_until", 0)
+
+
+    def __rate(self, action):
+        # tokens per second
+        return self.limits[action][0] / 3600 * self.__state[action]["factor"]
+
+    def __refill(self, action, now):
+        st = self.__state[action]
+        burst = self.limits[action][1]
+        st["tokens"] = min(burst, st["tokens"] + (now - st["updated"]) * self.__rate(action))
+        st["updated"] = now
+
+    def __save(self):
+        if not self.state_path: return
+        try:
+            tmp = self.state_path + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump(self.__state, file)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            self.shell.warn("Rate: could not save state:", str(e))
+
+
+    def delay(self, action: str) -> float:
+        """ Seconds until `action` may be done again. """
+        with self.__lock:
+            now = time.time()
+            self.__refill(action, now)
+            st = self.__state[action]
+            wait_tokens = 0 if st["tokens"] >= 1 else (1 - st["tokens"]) / self.__rate(action)
+            return max(st["blocked_until"] - now, wait_tokens, 0)
+
+    def take(self, action: str) -> None:
+        """ Uses up a token for `action`, whether or not one was available. """
+        with self.__lock:
+            self.__refill(action, time.time())
+            self.__state[action]["tokens"] -= 1
+            self.__save()
+
+    def acquire(self, action: str, sleep=time.sleep) -> bool:
+        """ Waits (with `sleep`) until `action` is allowed, then takes a token. Returns False if `sleep` was cut short. """
+        while (wait := self.delay(action)) > 0:
+            self.shell.debug("Rate:", action, "waiting", f"{wait:.1f}", "seconds")
+            if sleep(wait) is False: return False
+        self.take(action)
+        return True
+
+
+    def success(self, action: str) -> None:
+        """ Records that `action` went through, easing back toward the full rate. """
+        with self.__lock:
+            st = self.__state[action]
+            if st["factor"] >= 1 and st["level"] == 0: return
+            self.__refill(action, time.time())
+            st["factor"] = min(1.0, st["factor"] * RATE_RECOVERY)
+            st["level"] = max(0, st["level"] - 1)
+            self.__save()
+
+    def blocked(self, action: str, e: Exception = None) -> float:
+        """ Records that instagram refused `action` for going too fast. Returns the backoff, in seconds. """
+        with self.__lock:
+            now = time.time()
+            self.__refill(action, now)
+            st = self.__state[action]
+            backoff = min(RATE_BACKOFF_BASE_SECONDS * 2**st["level"], RATE_BACKOFF_MAX_SECONDS)
+            backoff *= random.uniform(0.5, 1.5)  # jitter, so retries don't line up
+            st["level"] += 1
+            st["factor"] = max(RATE_MIN_FACTOR, st["factor"] / 2)
+            st["blocked_until"] = now + backoff
+            st["tokens"] = min(st["tokens"], 0)
+            self.__save()
+        self.shell.warn("Rate:", action, "blocked" + ("" if e is None else f" ({type(e).__name__})") + ", backing off",
+                        self.shell.highlight(int(backoff)), "seconds; rate now",
+                        self.shell.highlight(f"{self.__state[action]['factor']:.0%}"), "of configured.")
+        return backoff
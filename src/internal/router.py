@@ -0,0 +1,97 @@
+"""decides which account's queue a sorted file goes to"""
+
+import os
+import re
+import threading
+
+from src.internal.post_queue import PostQueue
+from src.config import SORT_ROUTING, POST_OPTIONS_PATH
+
+from threadsafe_shell import Shell, get_shell
+
+
+def account_path(path: str, username: str, shared: bool) -> str:
+    """ Per-account variant of a configured file path: `media/queue.sqlite3` -> `media/queue-<username>.sqlite3`. """
+    if not path or not shared: return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{username}{ext}"
+
+
+class Route:
+    """ One destination: a queue, and the drop folder and tags that lead to it. """
+    def __init__(self, name: str, queue: PostQueue, folder: str = None, tags: list = ()):
+        self.name = name
+        self.queue = queue
+        self.folder = folder
+        self.tags = {tag.lower().lstrip("#") for tag in tags}
+
+
+class Router:
+    """
+    Hands each file coming out of the sort pipeline to one of several
+    PostQueues, so one conversion feeds every account.
+
+    `mode` is one of:
+      - "round_robin": accounts take turns
+      - "folder": files dropped in `media/outbound/<folder>/` go to the account with that folder
+      - "tag": a `#tag` in the filename, or a `--tag` option on its caption line, picks the account
+
+    Anything the mode can't place (a top-level file in folder mode, an
+    untagged file in tag mode) falls back to round-robin.
+    """
+
+    def __init__(self, routes: list, mode: str = SORT_ROUTING, outbound: str = "media/outbound", shell: Shell = None):
+        if not routes: raise ValueError("need at least one route")
+        self.routes = list(routes)
+        self.mode = mode
+        self.outbound = outbound
+        self.shell = get_shell() if shell is None else shell
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def queues(self) -> list:
+        return [route.queue for route in self.routes]
+
+    def __len__(self) -> int:
+        """ Files queued across every route. """
+        return sum(len(route.queue) for route in self.routes)
+
+
+    def __round_robin(self) -> Route:
+        with self.__lock:
+            route = self.routes[self.__next % len(self.routes)]
+            self.__next += 1
+            return route
+
+    def __by_folder(self, path):
+        parent = os.path.dirname(path)
+        if os.path.dirname(parent) != self.outbound: return None
+        sub = os.path.basename(parent)
+        for route in self.routes:
+            if route.folder == sub: return route
+        return None
+
+    def __by_tag(self, path):
+        name = os.path.basename(path)
+        tags = {tag.lower() for tag in re.findall(r"#(\w+)", name)}
+        # imported here, the caption store is only opened if tags are actually used
+        from src.internal.file_io import get_caption_store
+        store = get_caption_store()
+        store.import_text(POST_OPTIONS_PATH)
+        options = store.peek(name, os.path.splitext(name)[0])
+        if options and options.get("tag"):
+            tags.update(tag.lower().lstrip("#") for tag in options["tag"].split())
+        for route in self.routes:
+            if route.tags & tags: return route
+        return None
+
+    def route(self, path: str) -> PostQueue:
+        """ The queue a file (its source path in `media/outbound`) should end up in. """
+        if len(self.routes) == 1: return self.routes[0].queue
+        route = None
+        if self.mode == "folder": route = self.__by_folder(path)
+        elif self.mode == "tag": route = self.__by_tag(path)
+        if route is None: route = self.__round_robin()
+        self.shell.debug("Route:", path, "->", route.name)
+        return route.queue
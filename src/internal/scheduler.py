@@ -0,0 +1,45 @@
+"""blocking waits for the main loop"""
+
+import time
+import threading
+
+
+class Scheduler:
+    """
+    Lets the main loop sleep until something it cares about happens - a timer
+    running out, `notify` being called (e.g. the queue got a new item) or a
+    shutdown being requested - instead of spinning.
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__shutdown = False
+
+    def notify(self, *args, **kwargs) -> None:
+        """ Wakes anything waiting, so it can re-check its condition. Takes any arguments, to be usable as a callback. """
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def shutdown(self) -> None:
+        with self.__cond:
+            self.__shutdown = True
+            self.__cond.notify_all()
+
+    @property
+    def is_shutdown(self) -> bool:
+        return self.__shutdown
+
+
+    def wait_for(self, predicate, timeout: float = None) -> bool:
+        """
+        Blocks until `predicate()` is true, the timeout runs out or shutdown is
+        requested. Returns whether `predicate()` came true (False on timeout or shutdown).
+        """
+        with self.__cond:
+            return bool(self.__cond.wait_for(lambda: self.__shutdown or predicate(), timeout)) and not self.__shutdown
+
+    def sleep(self, seconds: float) -> bool:
+        """ Sleeps `seconds`, or less if shutdown is requested. Returns False if it was cut short. """
+        deadline = time.monotonic() + seconds
+        self.wait_for(lambda: time.monotonic() >= deadline, seconds)
+        return not self.__shutdown
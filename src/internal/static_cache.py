@@ -0,0 +1,141 @@
+"""in-memory, precompressed static files for the control panel"""
+
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from src.config import WEBSERVER_DEV_MODE, WEBSERVER_CACHE_SECONDS
+
+from threadsafe_shell import Shell, get_shell
+
+
+# not worth compressing: already compressed, or too small to win anything
+INCOMPRESSIBLE_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp", "font/woff2")
+MIN_COMPRESS_SIZE = 256
+
+
+class StaticFile:
+    """ One file's bytes, validators and compressed variants. """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.body = file.read()
+        self.mtime = os.stat(path).st_mtime
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        # encoding -> bytes, best first
+        self.variants = {}
+        if len(self.body) >= MIN_COMPRESS_SIZE and self.content_type not in INCOMPRESSIBLE_TYPES:
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(self.body, quality=11)
+            self.variants["gzip"] = gzip.compress(self.body, compresslevel=9, mtime=0)
+            self.variants = {enc: data for enc, data in self.variants.items() if len(data) < len(self.body)}
+
+
+class StaticCache:
+    """
+    The files under `folder`, read and compressed once at startup and served
+    from memory with ETag/Last-Modified, so a reload of the panel only costs
+    a few 304s. Clients that accept brotli or gzip get the precompressed
+    bytes.
+
+    In `dev_mode` every request checks the file's mtime and reloads it if it
+    changed, and nothing is cached by the browser.
+    """
+
+    def __init__(self, folder: str, dev_mode: bool = WEBSERVER_DEV_MODE, max_age: int = WEBSERVER_CACHE_SECONDS, shell: Shell = None):
+        self.folder = os.path.realpath(folder)
+        self.dev_mode = dev_mode
+        self.max_age = max_age
+        self.shell = get_shell() if shell is None else shell
+        self.__files = {}
+        self.__lock = threading.Lock()
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                self.__files[os.path.relpath(path, self.folder)] = StaticFile(path)
+        self.shell.debug("Static: cached", len(self.__files), "files from", folder)
+
+
+    def get(self, name: str) -> StaticFile:
+        """ The cached file at `name` (relative to the folder), or None. """
+        if not self.dev_mode: return self.__files.get(name)
+        path = os.path.realpath(os.path.join(self.folder, name))
+        if not path.startswith(self.folder + os.sep) or not os.path.isfile(path):
+            return None
+        with self.__lock:
+            cached = self.__files.get(name)
+            if cached is None or os.stat(path).st_mtime != cached.mtime:
+                self.shell.debug("Static: reloading", name)
+                cached = self.__files[name] = StaticFile(path)
+            return cached
+
+
+    def response(self, request: web.Request, name: str, max_age: int = None) -> web.Response:
+        """ Response for `name`: 304 if the client's copy is current, otherwise the best encoding it accepts. 404 if there's no such file. """
+        cached = self.get(name)
+        if cached is None: raise web.HTTPNotFound()
+        max_age = self.max_age if max_age is None else max_age
+        headers = {
+            "ETag": cached.etag,
+            "Last-Modified": cached.last_modified,
+            "Cache-Control": "no-cache" if self.dev_mode or max_age <= 0 else f"public, max-age={max_age}",
+            "Vary": "Accept-Encoding",
+        }
+        if self.__not_modified(request, cached): return web.Response(status=304, headers=headers)
+        body = cached.body
+        accepted = self.accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        # the client's favourite of the variants (a coding it doesn't name is covered by "*"), ours breaking ties
+        best = None
+        for encoding in cached.variants:
+            q = accepted.get(encoding, accepted.get("*", 0))
+            if q > 0 and (best is None or q > best[0]): best = (q, encoding)
+        if best is not None:
+            headers["Content-Encoding"] = best[1]
+            body = cached.variants[best[1]]
+        return web.Response(body=body, headers=headers, content_type=cached.content_type,
+                            charset="utf-8" if cached.content_type.startswith("text/") or cached.content_type.endswith("javascript") else None)
+
+    @staticmethod
+    def accepted_encodings(header: str) -> dict:
+        """ Parses an Accept-Encoding header into {coding: q-value}; a q of 0 means the client won't take that coding. """
+        accepted = {}
+        for part in header.split(","):
+            coding, *params = [piece.strip() for piece in part.split(";")]
+            if not coding: continue
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "q":
+                    try: q = float(value)
+                    except ValueError: q = 0.0
+            accepted[coding.lower()] = q
+        return accepted
+
+    @staticmethod
+    def __not_modified(request, cached):
+        # If-None-Match wins when both are sent
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return cached.etag in tags or "*" in tags
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try: return int(cached.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError): return False
+        return False
+
+
+    def __len__(self) -> int:
+        return len(self.__files)
@@ -0,0 +1,118 @@
+"""in-process counters and timings"""
+
+import re
+import time
+import threading
+from contextlib import contextmanager
+
+# seconds; roughly spans a quick image convert up to a slow video upload
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+__lock = threading.Lock()
+__counters = {}
+__gauges = {}
+__histograms = {}
+__gauge_functions = {}
+
+
+def __key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def incr(name: str, amount: float = 1, **labels) -> None:
+    """ Adds `amount` to a counter. """
+    key = __key(name, labels)
+    with __lock:
+        __counters[key] = __counters.get(key, 0) + amount
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """ Sets a gauge to `value`. """
+    with __lock:
+        __gauges[__key(name, labels)] = value
+
+def set_gauge_function(name: str, func, **labels) -> None:
+    """ Makes a gauge read its value from `func()` whenever it is looked at, instead of being kept up to date. """
+    with __lock:
+        __gauge_functions[__key(name, labels)] = func
+
+def observe(name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels) -> None:
+    """ Records one observation in a histogram. """
+    key = __key(name, labels)
+    with __lock:
+        hist = __histograms.get(key)
+        if hist is None:
+            hist = __histograms[key] = {"buckets": buckets, "counts": [0]*len(buckets), "count": 0, "sum": 0.0}
+        for i,bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+                break
+        hist["count"] += 1
+        hist["sum"] += value
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """ Observes how long the `with` block took, in seconds. """
+    start = time.perf_counter()
+    try: yield
+    finally: observe(name, time.perf_counter() - start, **labels)
+
+
+def get(name: str, **labels) -> float:
+    """ Current value of a counter or gauge, 0 if never set. """
+    key = __key(name, labels)
+    with __lock:
+        return __counters.get(key, __gauges.get(key, 0))
+
+def snapshot() -> dict:
+    """ Copy of everything recorded so far, keyed by (name, labels). """
+    with __lock:
+        snap = {
+            "counters": dict(__counters),
+            "gauges": dict(__gauges),
+            "histograms": {k: dict(v, counts=list(v["counts"])) for k,v in __histograms.items()},
+        }
+        functions = list(__gauge_functions.items())
+    # outside the lock, the functions may take locks of their own
+    for key, func in functions:
+        try: snap["gauges"][key] = func()
+        except Exception: pass
+    return snap
+
+
+def __prometheus_name(name):
+    return "igbot_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def __prometheus_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels: return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _,v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k,_),v in zip(labels, escaped)) + "}"
+
+def render_prometheus() -> str:
+    """ Everything recorded so far, in the Prometheus text exposition format. """
+    snap = snapshot()
+    lines = []
+    def family(series, kind, suffix=""):
+        by_name = {}
+        for (name, labels), value in series.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            metric = __prometheus_name(name) + suffix
+            lines.append(f"# TYPE {metric} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != "histogram":
+                    lines.append(f"{metric}{__prometheus_labels(labels)} {value}")
+                    continue
+                # prometheus buckets are cumulative, ours aren't
+                total = 0
+                for bound, count in zip(value["buckets"], value["counts"]):
+                    total += count
+                    lines.append(f"{metric}_bucket{__prometheus_labels(labels, le=bound)} {total}")
+                lines.append(f"{metric}_bucket{__prometheus_labels(labels, le='+Inf')} {value['count']}")
+                lines.append(f"{metric}_sum{__prometheus_labels(labels)} {value['sum']}")
+                lines.append(f"{metric}_count{__prometheus_labels(labels)} {value['count']}")
+    family(snap["counters"], "counter", "_total")
+    family(snap["gauges"], "gauge")
+    family(snap["histograms"], "histogram")
+    return "\n".join(lines) + "\n"
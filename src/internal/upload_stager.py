@@ -0,0 +1,206 @@
+"""prepares upcoming posts while the cooldown runs"""
+
+import os
+import time
+import threading
+import subprocess
+
+from PIL import Image
+
+from src.internal import stats
+from src.internal import media_probe
+from src.internal import file_io as fileio
+from src.internal.post_queue import PostQueue
+from src.internal.scheduler import Scheduler
+from src.config import STAGE_AHEAD_COUNT, POST_ALBUM_SIZE, POST_ALBUM_GROUPING, POST_ALBUM_ASPECT_TOLERANCE
+
+from threadsafe_shell import Shell, get_shell
+
+
+# instagram turns down longer videos in a carousel
+ALBUM_MAX_VIDEO_SECONDS = 60
+# video thumbnails go here rather than next to the videos, where they'd touch folders the queue journal watches
+THUMBNAIL_FOLDER = "media/tmp/thumbnails"
+
+
+class StagedPost:
+    """ A queued file with everything its upload needs already worked out. """
+    def __init__(self, path: str, kwargs: dict, info: dict = None, options: dict = None, caption_key: str = None):
+        self.path = path
+        self.kwargs = kwargs    # keyword arguments for PostQueue.post: caption, location, thumbnail...
+        self.info = info        # probe results for videos, image size for images
+        self.options = options  # its line from the options file, if it had one (not used up until it's posted)
+        self.caption_key = caption_key  # what that line was found under
+        self.staged_at = time.time()
+
+    @property
+    def group(self) -> str:
+        return (self.options or {}).get("group") or None
+
+    @property
+    def aspect(self) -> float:
+        if not self.info or not self.info.get("height"): return None
+        return self.info["width"] / self.info["height"]
+
+    def albumable(self) -> bool:
+        if self.path.endswith(".mp4"): return bool(self.info) and (self.info.get("duration") or 0) <= ALBUM_MAX_VIDEO_SECONDS
+        return True
+
+    def fits_with(self, lead: "StagedPost", rules: list, aspect_tolerance: float) -> bool:
+        """ Whether this can go in an album behind `lead`, going by `rules` (see `POST_ALBUM_GROUPING`). """
+        if not self.albumable(): return False
+        if "type" in rules and PostQueue.parse_path(self.path)[2] != PostQueue.parse_path(lead.path)[2]: return False
+        if "aspect" in rules:
+            if self.aspect is None or lead.aspect is None: return False
+            if abs(self.aspect - lead.aspect) > aspect_tolerance * lead.aspect: return False
+        if "group" in rules and self.group is None: return False
+        # grouped files stay with their group, whatever the rules
+        if self.group != lead.group: return False
+        # an album only gets one caption, so outside a group a file with its own can only lead one
+        return self.group is not None or not self.has_caption()
+
+    def has_caption(self) -> bool:
+        return bool(self.options) and bool(self.options.get("caption") or "latlon" in self.options)
+
+
+class UploadStager:
+    """
+    Lines up the next `depth` posts in the queue and prepares them in the
+    background: caption looked up, file checked, video probed and its
+    thumbnail extracted. When a post slot opens, `take` hands the next one
+    over and the upload call is all that's left; `posted` then uses up its caption.
+
+    With an `album_size` over 1, `take_album` gathers up to that many files
+    that go together (see `POST_ALBUM_GROUPING`) into one carousel post, and
+    twice that many are kept staged so there's something to pick from. None
+    of their captions are used up until the album is posted.
+    """
+
+    def __init__(self, queue: PostQueue, depth: int = STAGE_AHEAD_COUNT, album_size: int = POST_ALBUM_SIZE,
+                 grouping: list = POST_ALBUM_GROUPING, aspect_tolerance: float = POST_ALBUM_ASPECT_TOLERANCE, shell: Shell = None):
+        self.queue = queue
+        # instagram takes 2 to 10 files per carousel
+        self.album_size = min(max(album_size, 1), 10)
+        self.grouping = list(grouping)
+        self.aspect_tolerance = aspect_tolerance
+        self.depth = max(depth, 1, 2*self.album_size if self.album_size > 1 else 1)
+        self.shell = get_shell() if shell is None else shell
+        self.__staged = dict()
+        # held while staging one file, so `take` and the thread never stage the same one twice
+        self.__stage_lock = threading.Lock()
+        self.__scheduler = Scheduler()
+        queue.add_listener(self.__on_queue_change)
+
+    def posted(self, staged: StagedPost) -> None:
+        """ Uses up the caption of a staged file that was just posted. Until then it's only looked at, so nothing is lost if it never is. """
+        # exactly the line it was staged with: one added since was never posted
+        if staged.caption_key is not None: fileio.use_options(staged.caption_key)
+
+    def __on_queue_change(self, event, path):
+        if event not in PostQueue.NON_REMOVAL_EVENTS:
+            staged = self.__staged.pop(path, None)
+            if staged is not None and "thumbnail" in staged.kwargs:
+                try: os.remove(staged.kwargs["thumbnail"])
+                except FileNotFoundError: pass
+        self.__scheduler.notify()
+
+
+    def start(self) -> None:
+        threading.Thread(target=self.__thread, name="UploadStager-Daemon", daemon=True).start()
+
+    def stop(self) -> None:
+        self.__scheduler.shutdown()
+
+    def __thread(self):
+        while not self.__scheduler.is_shutdown:
+            # stage everything lined up, then line up more, until `depth` are ready
+            if not self.__scheduler.wait_for(lambda: self.__next_unstaged() is not None or
+                                             (len(self.queue.upcoming()) < self.depth and self.queue.unreserved() > 0)):
+                continue
+            path = self.__next_unstaged() or self.queue.reserve()
+            if path is None: continue
+            with self.__stage_lock:
+                if path not in self.__staged: self.__stage(path)
+
+    def __next_unstaged(self):
+        for path in self.queue.upcoming()[:self.depth]:
+            if path not in self.__staged: return path
+        return None
+
+
+    def take(self) -> StagedPost:
+        """ The post for the next file in the queue, staging it on the spot if the thread hasn't got to it. Returns None if the queue is empty. """
+        while True:
+            path = self.queue.get_next_filename()
+            if path is None: return None
+            with self.__stage_lock:
+                staged = self.__staged.get(path)
+                # media/tmp is cleared when the sorter starts, which may have taken the thumbnail with it
+                if staged is None or not os.path.exists(staged.kwargs.get("thumbnail", path)): staged = self.__stage(path)
+            if staged is not None: return staged
+            # it was bad and got discarded, try the next one
+
+    def take_album(self) -> list:
+        """
+        The posts for the next file in the queue and, in album mode, the
+        staged ones lined up after it that fit with it, up to `album_size`.
+        Empty if the queue is empty.
+        """
+        lead = self.take()
+        if lead is None: return []
+        album = [lead]
+        if self.album_size < 2 or self.queue.solo(lead.path) or not lead.albumable(): return album
+        for path in self.queue.upcoming()[1:self.depth]:
+            if len(album) >= self.album_size: break
+            if self.queue.solo(path): continue
+            # usually the thread got to it already
+            with self.__stage_lock:
+                staged = self.__staged.get(path) or self.__stage(path)
+            if staged is None: continue
+            if staged.fits_with(lead, self.grouping, self.aspect_tolerance): album.append(staged)
+        if len(album) > 1: self.shell.debug("Stage: Album of", len(album), "files led by", lead.path)
+        return album
+
+    @staticmethod
+    def album_options(album: list) -> dict:
+        """ Keyword arguments for `PostQueue.post_album`: the caption and location of the first file in the album that had any. """
+        for staged in album:
+            if staged.has_caption(): return dict(staged.kwargs)
+        return dict(album[0].kwargs)
+
+    def __stage(self, path):
+        start = time.perf_counter()
+        (folder, filename, filefmt) = PostQueue.parse_path(path)
+        try:
+            if os.path.getsize(path) == 0: raise ValueError("empty file")
+            if filefmt == "mp4":
+                info = media_probe.probe(path)
+                if info is None: raise ValueError("could not probe video")
+                os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+                thumbnail = f"{THUMBNAIL_FOLDER}/{os.path.basename(path)}.jpg"
+                subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-ss", str((info["duration"] or 0)/2),
+                                "-i", path, "-frames:v", "1", "-q:v", "2", thumbnail], check=True)
+                # instagrapi reads videos with moviepy, which is slow to import the first time - get that out of the way now
+                try: import moviepy.editor
+                except ImportError as e:
+                    # not this file's fault, so it stays queued; the upload will say so too
+                    self.shell.warn("Stage: Could not load moviepy, which instagrapi needs to upload videos -", str(e))
+            else:
+                with Image.open(path) as image:
+                    image.verify()
+                    info = {"width": image.width, "height": image.height}
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            self.shell.warn("Stage: Can't post", path, "-", str(e))
+            self.queue.discard(path, "failed staging: " + str(e))
+            return None
+        caption_key, options = fileio.find_options(path, self.queue.source_name(path))
+        kwargs = fileio.build_post_options(options)
+        if filefmt == "mp4": kwargs["thumbnail"] = thumbnail
+        staged = self.__staged[path] = StagedPost(path, kwargs, info, options, caption_key)
+        stats.observe("stage_seconds", time.perf_counter() - start, type=filefmt)
+        self.shell.debug("Stage: Ready to post", path)
+        return staged
+
+
+    def __len__(self) -> int:
+        return len(self.__staged)
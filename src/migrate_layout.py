@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+# Moves media/sorted and media/discard from the old flat layout (one folder, files named after what was dropped
+# in, `-1`/`-2` on clashes) into the sharded one (`media/sorted/jpg/ab/cd/<id>.jpg`, see src/internal/media_layout.py).
+# Queued files keep their place in the queue journals, remember their old name so their captions are still found,
+# and the dedup index is pointed at the new paths. Only files still at the top of a folder are moved, so it can be
+# run again safely. Stop the bot first.
+#
+#   python3 -m src.migrate_layout [--dry-run]
+"""
+
+import os
+import sys
+
+from threadsafe_shell import get_shell
+
+from src.internal import media_layout
+from src.internal.queue_journal import QueueJournal
+from src.internal.dedup_index import DedupIndex
+from src.internal.router import account_path
+
+import src.config as config
+
+
+def journal_paths() -> list:
+    """ Every queue journal the configured accounts use. """
+    if not config.QUEUE_JOURNAL_PATH: return []
+    settings = config.ACCOUNTS or [{"username": config.IG_USERNAME}]
+    return [account_path(config.QUEUE_JOURNAL_PATH, account["username"], len(settings) > 1) for account in settings]
+
+
+def migrate(dry_run: bool = False, shell=None) -> dict:
+    """ Moves every flat file into its shard. Returns how many files of each kind were moved. """
+    shell = get_shell() if shell is None else shell
+    journals = [QueueJournal(path) for path in journal_paths() if os.path.exists(path)]
+    dedup = DedupIndex(config.DEDUP_INDEX_PATH, config.DEDUP_MAX_DISTANCE) if config.DEDUP_INDEX_PATH and os.path.exists(config.DEDUP_INDEX_PATH) else None
+    counts = {"sorted": 0, "queued": 0, "discard": 0, "thumbnails": 0}
+
+    for fmt in ("jpg", "mp4"):
+        for path in media_layout.flat_files(f"{media_layout.SORTED_ROOT}/{fmt}"):
+            if path.endswith(".mp4.jpg"):
+                # leftover upload thumbnail, made again when it's needed
+                if not dry_run: os.remove(path)
+                counts["thumbnails"] += 1
+                continue
+            new_path = media_layout.sorted_path(fmt)
+            counts["sorted"] += 1
+            if dry_run: continue
+            media_layout.move(path, new_path)
+            # the old name is the one it came in with (maybe with a -1), which is what its caption was written for
+            queued = [journal.rename(path, new_path, os.path.basename(path)) for journal in journals]
+            if any(queued): counts["queued"] += 1
+            if dedup is not None: dedup.rename_path(path, new_path)
+            shell.debug("Moved", path, "to", new_path)
+
+    # posted files sit at the top of media/discard, everything else in a folder per reason
+    roots = [media_layout.DISCARD_ROOT]
+    if os.path.isdir(media_layout.DISCARD_ROOT):
+        roots += [entry.path for entry in os.scandir(media_layout.DISCARD_ROOT) if entry.is_dir() and len(entry.name) != 2]
+    for root in roots:
+        reason = None if root == media_layout.DISCARD_ROOT else os.path.basename(root)
+        for path in media_layout.flat_files(root):
+            counts["discard"] += 1
+            if dry_run: continue
+            new_path = media_layout.move(path, media_layout.discard_path(path, reason))
+            if dedup is not None: dedup.rename_path(path, new_path)
+
+    for journal in journals: journal.close()
+    return counts
+
+
+if __name__ == "__main__":
+    shell = get_shell()
+    dry_run = "--dry-run" in sys.argv[1:]
+    counts = migrate(dry_run, shell)
+    shell.success("Would move" if dry_run else "Moved", shell.highlight(counts["sorted"]), "sorted files",
+                  f"({shell.highlight(counts['queued'])} of them queued) and", shell.highlight(counts["discard"]), "discarded files,",
+                  "and removed" if not dry_run else "and would remove", shell.highlight(counts["thumbnails"]), "leftover thumbnails.")
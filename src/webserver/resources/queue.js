@@ -0,0 +1,111 @@
+// webserver/queue.js
+// shows the post queues, a page at a time, and keeps them up to date from the deltas sent over the websocket.
+
+const PAGE_SIZE = 100;
+// account name -> {el, summary, rows: Map(path -> row element), nextCursor, done}
+// (elements are kept here rather than looked up by id: usernames can have dots, which selectors would misread)
+const queues = new Map();
+
+function escape_html(s) {
+    return String(s).replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+}
+
+async function queue_action(account, action, body) {
+    const res = await fetch(`/api/queues/${encodeURIComponent(account)}/${action}`, {
+        method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(body || {}),
+    });
+    const data = await res.json();
+    if (!res.ok) add_log_entry(`<span class="colored color_red">${escape_html(data.error)}</span>`);
+}
+
+function render_summary(summary) {
+    const q = queues.get(summary.account);
+    if (!q) return;
+    q.summary = summary;
+    const el = q.el;
+    el.querySelector('.queue-status').textContent =
+        `${summary.length} queued, next post in ${summary.cooldown}s` + (summary.paused ? ' (paused)' : '');
+    el.querySelector('.queue-toggle').textContent = summary.paused ? 'Resume' : 'Pause';
+    el.querySelector('.queue-upcoming').innerHTML = summary.upcoming.map(p => `<li>${escape_html(p)}</li>`).join('');
+}
+
+function make_row(account, item) {
+    const row = document.createElement('tr');
+    row.innerHTML = `<td>${item.seq}</td><td>${escape_html(item.path)}</td>
+        <td><button class="pin">Post next</button> <button class="remove">Remove</button></td>`;
+    row.querySelector('.pin').onclick = () => queue_action(account, 'pin', {path: item.path});
+    row.querySelector('.remove').onclick = () => queue_action(account, 'remove', {path: item.path});
+    return row;
+}
+
+async function load_page(account) {
+    const q = queues.get(account);
+    if (q.done || q.loading) return;
+    q.loading = true;
+    const cursor = q.nextCursor == null ? '' : q.nextCursor;
+    const res = await fetch(`/api/queues/${encodeURIComponent(account)}?cursor=${cursor}&limit=${PAGE_SIZE}`);
+    const page = await res.json();
+    q.loading = false;
+    const body = q.el.querySelector('tbody');
+    for (const item of page.items) {
+        if (q.rows.has(item.path)) continue;
+        const row = make_row(account, item);
+        q.rows.set(item.path, row);
+        body.appendChild(row);
+    }
+    q.nextCursor = page.next_cursor;
+    q.done = page.next_cursor == null;
+    q.el.querySelector('.queue-more').hidden = q.done;
+    render_summary(page);
+}
+
+async function load_queues() {
+    const info = document.getElementById('info');
+    const res = await fetch('/api/queues');
+    const data = await res.json();
+    queues.clear();
+    info.innerHTML = '';
+    for (const summary of data.queues) {
+        const el = document.createElement('div');
+        el.className = 'queue';
+        el.id = `queue-${summary.account}`;
+        el.innerHTML = `<h3>${escape_html(summary.account)} <span class="queue-status"></span>
+            <button class="queue-toggle"></button></h3>
+            <ol class="queue-upcoming"></ol>
+            <div class="queue-items"><table><tbody></tbody></table></div>
+            <button class="queue-more">Load more</button>`;
+        info.appendChild(el);
+        queues.set(summary.account, {el, summary, rows: new Map(), nextCursor: null, done: false, loading: false});
+        el.querySelector('.queue-toggle').onclick = () =>
+            queue_action(summary.account, queues.get(summary.account).summary.paused ? 'resume' : 'pause');
+        el.querySelector('.queue-more').onclick = () => load_page(summary.account);
+        // next page when scrolled to the bottom, so a huge queue only loads what is looked at
+        const items = el.querySelector('.queue-items');
+        items.onscroll = () => { if (items.scrollTop + items.clientHeight >= items.scrollHeight - 20) load_page(summary.account); };
+        await load_page(summary.account);
+    }
+}
+
+function apply_queue_delta(rec) {
+    for (const [account, event, path, seq] of rec.events) {
+        const q = queues.get(account);
+        if (!q) continue;
+        if (event === 'add') {
+            // new items sort last, so they only belong on screen once the rest is loaded
+            if (q.done && !q.rows.has(path)) {
+                const row = make_row(account, {path, seq});
+                q.rows.set(path, row);
+                q.el.querySelector('tbody').appendChild(row);
+            }
+        } else if (!['lineup', 'pause', 'resume'].includes(event)) {
+            const row = q.rows.get(path);
+            if (row) { row.remove(); q.rows.delete(path); }
+        }
+    }
+    for (const summary of rec.queues) render_summary(summary);
+}
+
+function handle_queue_message(rec) {
+    if (rec.method === 'queue_delta') apply_queue_delta(rec);
+    else if (rec.method === 'queue_resync') load_queues();
+}
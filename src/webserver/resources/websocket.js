@@ -5,14 +5,32 @@ const protocol = (location.protocol==="http:") ? 'ws' : 'wss';
 const url = `${protocol}://${location.host}/ws/app/`;
 const ws = new ReconnectingWebSocket(url, null, {debug: true, reconnectInterval: 3000});
 
-function add_log_entry(msg) {
+// the server replays its history on every connect, so the panel only keeps about that much
+const MAX_LOG_ENTRIES = 2000;
+
+function log_entry_html(msg) {
+    return `<div class="logentry"> <span> ${msg} </span> </div>`;
+}
+
+function add_log_entries(msgs) {
     const logDiv = document.getElementById("log");
-    logDiv.insertAdjacentHTML('beforeend', `<div class="logentry"> <span> ${msg} </span> </div>`);
-    logDiv.scrollTop = logDiv.scrollHeight;
+    const atBottom = logDiv.scrollTop + logDiv.clientHeight >= logDiv.scrollHeight - 4;
+    // one insert per batch, not per line
+    logDiv.insertAdjacentHTML('beforeend', msgs.map(log_entry_html).join(''));
+    while (logDiv.childElementCount > MAX_LOG_ENTRIES) logDiv.firstElementChild.remove();
+    if (atBottom) logDiv.scrollTop = logDiv.scrollHeight;
+}
+
+function add_log_entry(msg) {
+    add_log_entries([msg]);
 }
 
 ws.onopen = (event) => {
+    // the history replay follows, so start from a clean log
+    document.getElementById("log").replaceChildren();
     add_log_entry('Connection opened.');
+    // anything could have changed while disconnected
+    load_queues();
 }
 
 ws.onclose = (event) => {
@@ -26,4 +44,14 @@ ws.onmessage = function(event) {
     if (rec.method === "write") {
         add_log_entry(rec.data);
     }
+    else if (rec.method === "write_batch") {
+        if (rec.skipped) add_log_entry(`<span class="colored color_yellow">(${rec.skipped} lines skipped, the panel fell behind)</span>`);
+        add_log_entries(rec.data);
+    }
+    else if (rec.method.startsWith("queue_")) {
+        handle_queue_message(rec);
+    }
+    else if (rec.method === "reply" && rec.error) {
+        add_log_entry(`<span class="colored color_red">${rec.for}: ${rec.error}</span>`);
+    }
 }